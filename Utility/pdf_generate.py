@@ -1,94 +1,135 @@
 """
 This module is used to generate a PDF document from a list of questions.
+
+Paragraph styles come from a registry that is built once at import and
+shared by every render. Per-school looks are registered as named themes
+(overrides on top of the default styles) and cached the first time they are
+used. Styles handed out by get_styles() are shared: never mutate them.
 """
 
 import io
+import threading
+from types import MappingProxyType
 from reportlab.lib.pagesizes import letter
 from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
 
-def create_pdf(questions, filename):
+DEFAULT_THEME = 'default'
+
+# Bump whenever the rendered layout changes, so content-addressed PDFs are re-rendered
+LAYOUT_VERSION = 1
+
+# Style key -> (parent style in the sample sheet, ParagraphStyle attributes)
+STYLE_DEFINITIONS = {
+    'title': ('Heading1', {
+        'fontSize': 20,
+        'spaceAfter': 30,
+        'alignment': 1,  # Center alignment
+        'textColor': '#2c3e50'  # Dark blue color
+    }),
+    'header': ('Heading2', {
+        'fontSize': 14,
+        'spaceAfter': 20,
+        'textColor': '#34495e'  # Slightly lighter blue
+    }),
+    'question': ('Normal', {
+        'fontSize': 12,
+        'spaceAfter': 10,
+        'textColor': '#2c3e50',
+        'backColor': '#f8f9fa',  # Light gray background
+        'borderPadding': 5,
+        'borderColor': '#dee2e6',
+        'borderWidth': 1
+    }),
+    'option': ('Normal', {
+        'fontSize': 11,
+        'leftIndent': 20,
+        'spaceAfter': 5,
+        'textColor': '#495057'
+    }),
+    'answer': ('Normal', {
+        'fontSize': 12,
+        'spaceAfter': 10,
+        'textColor': '#28a745',  # Green color for answers
+        'backColor': '#e8f5e9',  # Light green background
+        'borderPadding': 5,
+        'borderColor': '#c8e6c9',
+        'borderWidth': 1
+    }),
+    'explanation': ('Normal', {
+        'fontSize': 11,
+        'spaceAfter': 20,
+        'textColor': '#6c757d',
+        'leftIndent': 20
+    }),
+    'detail': ('Normal', {}),
+}
+
+_sample_styles = getSampleStyleSheet()
+_themes = {DEFAULT_THEME: MappingProxyType({})}
+_style_cache = {}
+_lock = threading.Lock()
+
+def build_styles(overrides=None):
+    """Build a fresh style set, applying {style key: {attribute: value}} overrides"""
+    overrides = overrides or {}
+    styles = {}
+    for key, (parent, attributes) in STYLE_DEFINITIONS.items():
+        styles[key] = ParagraphStyle(
+            f"{key.capitalize()}Style",
+            parent=_sample_styles[parent],
+            **{**attributes, **overrides.get(key, {})}
+        )
+    return MappingProxyType(styles)
+
+def register_theme(name, overrides):
+    """Register (or replace) a named theme, e.g. a school's colours and fonts"""
+    unknown = set(overrides) - set(STYLE_DEFINITIONS)
+    if unknown:
+        raise ValueError(f"Unknown style keys in theme '{name}': {sorted(unknown)}")
+    frozen = MappingProxyType({key: dict(attrs) for key, attrs in overrides.items()})
+    with _lock:
+        _themes[name] = frozen
+        _style_cache.pop(name, None)
+
+def get_styles(theme=DEFAULT_THEME):
+    """Shared, read-only styles for a theme; unknown themes fall back to the default"""
+    theme = theme if theme in _themes else DEFAULT_THEME
+    styles = _style_cache.get(theme)
+    if styles is None:
+        with _lock:
+            styles = _style_cache.get(theme)
+            if styles is None:
+                styles = build_styles(_themes[theme])
+                _style_cache[theme] = styles
+    return styles
+
+DEFAULT_STYLES = get_styles()
+
+def themes():
+    """Registered theme overrides as plain dicts, e.g. to seed worker processes"""
+    with _lock:
+        return {name: {key: dict(attrs) for key, attrs in overrides.items()}
+                for name, overrides in _themes.items() if name != DEFAULT_THEME}
+
+def register_themes(theme_overrides):
+    """Register several themes at once; used as a worker process initializer"""
+    for name, overrides in theme_overrides.items():
+        register_theme(name, overrides)
+
+def build_pdf(questions, details, theme=DEFAULT_THEME):
+    """Render a question paper with the given detail lines; returns a BytesIO"""
     # Create PDF in memory
     pdf_buffer = io.BytesIO()
     doc = SimpleDocTemplate(pdf_buffer, pagesize=letter)
-    styles = getSampleStyleSheet()
+    styles = get_styles(theme)
     story = []
     
-    # Define custom styles
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Heading1'],
-        fontSize=20,
-        spaceAfter=30,
-        alignment=1,  # Center alignment
-        textColor='#2c3e50'  # Dark blue color
-    )
-    
-    header_style = ParagraphStyle(
-        'HeaderStyle',
-        parent=styles['Heading2'],
-        fontSize=14,
-        spaceAfter=20,
-        textColor='#34495e'  # Slightly lighter blue
-    )
-    
-    question_style = ParagraphStyle(
-        'QuestionStyle',
-        parent=styles['Normal'],
-        fontSize=12,
-        spaceAfter=10,
-        textColor='#2c3e50',
-        backColor='#f8f9fa',  # Light gray background
-        borderPadding=5,
-        borderColor='#dee2e6',
-        borderWidth=1
-    )
-    
-    option_style = ParagraphStyle(
-        'OptionStyle',
-        parent=styles['Normal'],
-        fontSize=11,
-        leftIndent=20,
-        spaceAfter=5,
-        textColor='#495057'
-    )
-    
-    answer_style = ParagraphStyle(
-        'AnswerStyle',
-        parent=styles['Normal'],
-        fontSize=12,
-        spaceAfter=10,
-        textColor='#28a745',  # Green color for answers
-        backColor='#e8f5e9',  # Light green background
-        borderPadding=5,
-        borderColor='#c8e6c9',
-        borderWidth=1
-    )
-    
-    explanation_style = ParagraphStyle(
-        'ExplanationStyle',
-        parent=styles['Normal'],
-        fontSize=11,
-        spaceAfter=20,
-        textColor='#6c757d',
-        leftIndent=20
-    )
-    
     # Add title and paper details
-    story.append(Paragraph("QUESTION PAPER", title_style))
-    
-    # Add paper details
-    details = [
-        f"<b>Class:</b> {questions[0]['classGrade']}",
-        f"<b>Subject:</b> {questions[0]['subjectName']}",
-        f"<b>Total Questions:</b> {sum(len(topic['questions']) for topic in questions)}",
-        f"<b>Difficulty Level:</b> {questions[0]['difficulty']}",
-        f"<b>Bloom's Level:</b> {questions[0]['bloomLevel']}",
-        f"<b>Intelligence Type:</b> {questions[0]['intelligenceType']}"
-    ]
+    story.append(Paragraph("QUESTION PAPER", styles['title']))
     
     for detail in details:
-        story.append(Paragraph(detail, styles['Normal']))
+        story.append(Paragraph(detail, styles['detail']))
         story.append(Spacer(1, 5))
     
     story.append(Spacer(1, 20))
@@ -96,24 +137,24 @@ def create_pdf(questions, filename):
     # Add questions
     for i, topic in enumerate(questions, 1):
         # Add topic header
-        story.append(Paragraph(f"Topic {i}: {topic['topic']}", header_style))
+        story.append(Paragraph(f"Topic {i}: {topic['topic']}", styles['header']))
         story.append(Spacer(1, 10))
         
         # Add questions
         for j, q in enumerate(topic['questions'], 1):
             # Question text
-            story.append(Paragraph(f"Q{j}. {q['question']}", question_style))
+            story.append(Paragraph(f"Q{j}. {q['question']}", styles['question']))
             
             # Options (if MCQ)
             if 'options' in q:
                 for opt in q['options']:
-                    story.append(Paragraph(f"• {opt}", option_style))
+                    story.append(Paragraph(f"• {opt}", styles['option']))
             
             # Answer
-            story.append(Paragraph(f"<b>Answer:</b> {q['answer']}", answer_style))
+            story.append(Paragraph(f"<b>Answer:</b> {q['answer']}", styles['answer']))
             
             # Explanation
-            story.append(Paragraph(f"<b>Explanation:</b> {q['explanation']}", explanation_style))
+            story.append(Paragraph(f"<b>Explanation:</b> {q['explanation']}", styles['explanation']))
             
             # Add spacing between questions
             story.append(Spacer(1, 15))
@@ -121,3 +162,27 @@ def create_pdf(questions, filename):
     doc.build(story)
     pdf_buffer.seek(0)
     return pdf_buffer
+
+def render_question_paper(questions, subject_name, class_grade, theme=DEFAULT_THEME):
+    """Render a generated paper to PDF bytes.
+
+    Module-level and free of app state so it can run in a worker process.
+    """
+    details = [
+        f"<b>Class:</b> {class_grade}",
+        f"<b>Subject:</b> {subject_name}",
+        f"<b>Total Questions:</b> {sum(len(topic['questions']) for topic in questions)}"
+    ]
+    return build_pdf(questions, details, theme).getvalue()
+
+def create_pdf(questions, filename, theme=DEFAULT_THEME):
+    # Add paper details
+    details = [
+        f"<b>Class:</b> {questions[0]['classGrade']}",
+        f"<b>Subject:</b> {questions[0]['subjectName']}",
+        f"<b>Total Questions:</b> {sum(len(topic['questions']) for topic in questions)}",
+        f"<b>Difficulty Level:</b> {questions[0]['difficulty']}",
+        f"<b>Bloom's Level:</b> {questions[0]['bloomLevel']}",
+        f"<b>Intelligence Type:</b> {questions[0]['intelligenceType']}"
+    ]
+    return build_pdf(questions, details, theme)
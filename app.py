@@ -1,6 +1,7 @@
-from flask import Flask, request, jsonify, send_from_directory, make_response
+from flask import Flask, request, jsonify, send_from_directory, make_response, Response, stream_with_context
 from flask_cors import CORS
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import OperationFailure
 from datetime import datetime, timedelta
 import os
 from dotenv import load_dotenv
@@ -9,16 +10,45 @@ import openai
 import json
 from bson import ObjectId
 import httpx
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
-from reportlab.lib.pagesizes import letter
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from Utility.pdf_generate import (
+    DEFAULT_THEME,
+    LAYOUT_VERSION as PDF_LAYOUT_VERSION,
+    register_theme as register_pdf_theme,
+    register_themes as register_pdf_themes,
+    render_question_paper,
+    themes as pdf_themes,
+)
 import boto3
 from botocore.exceptions import ClientError
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.utils import secure_filename
 import io
+import re
+import math
+import tempfile
+import base64
+import zipfile
+import multiprocessing
 import asyncio
 import hashlib
-from concurrent.futures import ThreadPoolExecutor
+import queue
+import contextlib
+import threading
+import time
+import functools
+import zlib
+import random
+from email.utils import parsedate_to_datetime
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 from asgiref.sync import async_to_sync
+import numpy as np
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
 
 # Load environment variables
 load_dotenv()
@@ -42,17 +72,139 @@ try:
     REQUEST_COLLECTION = os.getenv('REQUEST_COLLECTION', 'question_requests')
     PAPER_COLLECTION = os.getenv('PAPER_COLLECTION', 'question_papers')
     FEEDBACK_COLLECTION = os.getenv('FEEDBACK_COLLECTION', 'paper_feedback')
+    CACHE_COLLECTION = os.getenv('CACHE_COLLECTION', 'question_cache')
+    CACHE_TTL_DAYS = int(os.getenv('CACHE_TTL_DAYS', 7))
+    PDF_JOB_COLLECTION = os.getenv('PDF_JOB_COLLECTION', 'pdf_jobs')
+    NOTE_JOB_COLLECTION = os.getenv('NOTE_JOB_COLLECTION', 'note_jobs')
+    NOTE_CHUNK_COLLECTION = os.getenv('NOTE_CHUNK_COLLECTION', 'note_chunks')
     
     client = MongoClient(MONGODB_URI)
     db = client[DB_NAME]
     requests_collection = db[REQUEST_COLLECTION]
     papers_collection = db[PAPER_COLLECTION]
     feedback_collection = db[FEEDBACK_COLLECTION]
+    cache_collection = db[CACHE_COLLECTION]
+    pdf_jobs_collection = db[PDF_JOB_COLLECTION]
+    note_jobs_collection = db[NOTE_JOB_COLLECTION]
+    note_chunks_collection = db[NOTE_CHUNK_COLLECTION]
     print("✅ MongoDB Connection Successful!")
 except Exception as e:
     print("❌ MongoDB Connection Error:", e)
     db = None
 
+def required_indexes():
+    """Indexes backing the hot queries, as (collection, keys, options) tuples"""
+    return [
+        # Question cache: one document per cache_key, expired by Mongo's TTL monitor
+        (cache_collection, [('cache_key', ASCENDING)], {'unique': True}),
+        (cache_collection, [('created_at', ASCENDING)], {'expireAfterSeconds': CACHE_TTL_DAYS * 24 * 3600}),
+        (feedback_collection, [('paper_id', ASCENDING), ('created_at', DESCENDING)], {}),
+        (db['notes'], [('uploaded_at', DESCENDING)], {}),
+        # PDF workers claim queued jobs and reclaim expired leases
+        (pdf_jobs_collection, [('status', ASCENDING), ('lease_expires_at', ASCENDING)], {}),
+        (note_jobs_collection, [('status', ASCENDING), ('lease_expires_at', ASCENDING)], {}),
+        # Note chunks are read back in order for prompt context
+        (note_chunks_collection, [('note_id', ASCENDING), ('index', ASCENDING)], {}),
+        # Filtered listings page newest-first on _id; each filter combination
+        # needs its own prefix so the sort comes from the index
+        (requests_collection, [('subjectName', ASCENDING), ('classGrade', ASCENDING), ('_id', DESCENDING)], {}),
+        (requests_collection, [('subjectName', ASCENDING), ('_id', DESCENDING)], {}),
+        (requests_collection, [('classGrade', ASCENDING), ('_id', DESCENDING)], {}),
+        (papers_collection, [('subjectName', ASCENDING), ('classGrade', ASCENDING), ('_id', DESCENDING)], {}),
+        (papers_collection, [('subjectName', ASCENDING), ('_id', DESCENDING)], {}),
+        (papers_collection, [('classGrade', ASCENDING), ('_id', DESCENDING)], {}),
+    ]
+
+# Server error code when an index exists with the same keys but other options
+INDEX_OPTIONS_CONFLICT = 85
+
+def ensure_indexes():
+    """Create the required indexes; safe to run repeatedly.
+
+    Each index is created on its own, so one failure does not stop the
+    rest; returns {"collection.keys": error} for those that failed. A TTL
+    index whose expireAfterSeconds changed (CACHE_TTL_DAYS) is updated in
+    place with collMod.
+    """
+    failures = {}
+    for collection, keys, options in required_indexes():
+        index_name = '_'.join(f'{field}_{direction}' for field, direction in keys)
+        label = f"{collection.name}.{index_name}"
+        try:
+            try:
+                name = collection.create_index(keys, **options)
+            except OperationFailure as e:
+                if e.code != INDEX_OPTIONS_CONFLICT or 'expireAfterSeconds' not in options:
+                    raise
+                collection.database.command(
+                    'collMod', collection.name,
+                    index={'keyPattern': dict(keys), 'expireAfterSeconds': options['expireAfterSeconds']}
+                )
+                name = f"{index_name} (expireAfterSeconds now {options['expireAfterSeconds']})"
+            print(f"Index ready: {collection.name}.{name}")
+        except Exception as e:
+            print(f"❌ Error creating index {label}: {e}")
+            failures[label] = str(e)
+    return failures
+
+def hot_queries():
+    """Representative cursors for the queries served on every request"""
+    queries = {
+        'question_cache by cache_key': cache_collection.find(
+            {'cache_key': '', 'created_at': {'$gte': datetime.utcnow()}}
+        ).limit(1),
+        'paper_feedback by paper_id': feedback_collection.find({'paper_id': ''}),
+        'notes by uploaded_at': db['notes'].find().sort('uploaded_at', DESCENDING),
+    }
+    # Every filter combination the /api/requests and /api/papers listings accept
+    listing_filters = {
+        '': {},
+        ' by subject': {'subjectName': ''},
+        ' by class': {'classGrade': ''},
+        ' by subject and class': {'subjectName': '', 'classGrade': ''},
+    }
+    for label, listing_filter in listing_filters.items():
+        queries[f'question_requests page{label}'] = requests_collection.find(
+            listing_filter
+        ).sort('_id', DESCENDING).limit(PAGE_SIZE_DEFAULT + 1)
+        queries[f'question_papers page{label}'] = papers_collection.find(
+            {**listing_filter, 'cache_key': {'$exists': False}}
+        ).sort('_id', DESCENDING).limit(PAGE_SIZE_DEFAULT + 1)
+    return queries
+
+def plan_stages(plan):
+    """Flatten the stage names of an explain() winning plan"""
+    plan = plan.get('queryPlan', plan)
+    stages = [plan.get('stage')]
+    children = plan.get('inputStages', [])
+    if plan.get('inputStage'):
+        children = [plan['inputStage']] + children
+    for child in children:
+        stages.extend(plan_stages(child))
+    return stages
+
+def audit_query_plans():
+    """Explain each hot query; return {name: stages} for those using COLLSCAN or a blocking SORT"""
+    failures = {}
+    for name, cursor in hot_queries().items():
+        stages = plan_stages(cursor.explain()['queryPlanner']['winningPlan'])
+        print(f"{name}: {' <- '.join(stages)}")
+        if 'COLLSCAN' in stages or 'SORT' in stages:
+            failures[name] = stages
+    return failures
+
+def startup():
+    """One-time startup work for the server and CLI entry points.
+
+    Kept out of import: PDF render workers are spawned processes that
+    re-import the main script, and must not repeat it.
+    """
+    failures = ensure_indexes()
+    if failures:
+        print(f"❌ {len(failures)} MongoDB indexes could not be created: {', '.join(failures)}")
+    else:
+        print("✅ MongoDB indexes ready")
+
 # Initialize OpenAI client
 try:
     http_client = httpx.Client(
@@ -70,6 +222,337 @@ except Exception as e:
     print(f"❌ Error initializing OpenAI client: {e}")
     raise
 
+class AsyncOpenAIPool:
+    """AsyncOpenAI on one shared httpx.AsyncClient, driven by a background event loop.
+
+    Flask runs every async view in a fresh event loop, and an AsyncClient's
+    connections belong to the loop that opened them. So the client lives on
+    a long-lived loop of its own, and callers on any thread or loop submit
+    coroutines to it; every request shares one pool (and, with HTTP/2, a few
+    multiplexed connections). Pool wait is the time from handing a request
+    to httpx until it gets a connection.
+    """
+
+    def __init__(self, api_key, limits, timeout, http2=True):
+        self.limits = limits
+        self.timeout = timeout
+        self.http2 = http2
+        try:
+            self.http_client = self.build_http_client(http2)
+        except ImportError:
+            print("⚠️ h2 is not installed; OpenAI requests fall back to HTTP/1.1")
+            self.http2 = False
+            self.http_client = self.build_http_client(False)
+        # Retries are handled by ResilientOpenAIClient
+        self.client = openai.AsyncOpenAI(api_key=api_key, http_client=self.http_client, max_retries=0)
+        self.loop = None
+        self.requests = 0
+        self.connections_opened = 0
+        self.pool_waits = 0
+        self.pool_wait_total = 0.0
+        self.pool_wait_max = 0.0
+        self._lock = threading.Lock()
+
+    def build_http_client(self, http2):
+        return httpx.AsyncClient(
+            http2=http2,
+            limits=self.limits,
+            timeout=self.timeout,
+            follow_redirects=True,
+            event_hooks={'request': [self.on_request]}
+        )
+
+    async def on_request(self, request):
+        queued_at = time.monotonic()
+        waiting = True
+        with self._lock:
+            self.requests += 1
+
+        async def trace(name, info):
+            nonlocal waiting
+            if name == 'connection.connect_tcp.started':
+                with self._lock:
+                    self.connections_opened += 1
+            # The first connection-level event means the pool handed one over
+            if waiting and (name == 'connection.connect_tcp.started'
+                            or name.endswith('.send_request_headers.started')):
+                waiting = False
+                waited = time.monotonic() - queued_at
+                with self._lock:
+                    self.pool_waits += 1
+                    self.pool_wait_total += waited
+                    self.pool_wait_max = max(self.pool_wait_max, waited)
+
+        request.extensions['trace'] = trace
+
+    def get_loop(self):
+        with self._lock:
+            if self.loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='openai-io', daemon=True).start()
+                self.loop = loop
+            return self.loop
+
+    def submit(self, coro):
+        """Schedule a coroutine on the pool's loop; returns a concurrent Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.get_loop())
+
+    def iterate(self, agen):
+        """Drive an async generator on the pool's loop and yield its items here.
+
+        Closing this generator cancels the async one, which runs its cleanup.
+        """
+        items = queue.Queue()
+        done = object()
+
+        async def pump():
+            try:
+                async for item in agen:
+                    items.put((item, None))
+            except asyncio.CancelledError:
+                raise
+            except BaseException as e:
+                items.put((None, e))
+            else:
+                items.put((done, None))
+            finally:
+                await agen.aclose()
+
+        future = self.submit(pump())
+        try:
+            while True:
+                item, error = items.get()
+                if error is not None:
+                    raise error
+                if item is done:
+                    return
+                yield item
+        finally:
+            future.cancel()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'http2': self.http2,
+                'max_connections': self.limits.max_connections,
+                'max_keepalive_connections': self.limits.max_keepalive_connections,
+                'requests': self.requests,
+                'connections_opened': self.connections_opened,
+                'pool_wait_avg': self.pool_wait_total / self.pool_waits if self.pool_waits else 0.0,
+                'pool_wait_max': self.pool_wait_max
+            }
+
+# Separate connect / read / pool timeouts for each OpenAI attempt
+openai_timeout = httpx.Timeout(
+    float(os.getenv('OPENAI_ATTEMPT_TIMEOUT', 60)),
+    connect=float(os.getenv('OPENAI_CONNECT_TIMEOUT', 5)),
+    pool=float(os.getenv('OPENAI_POOL_TIMEOUT', 10))
+)
+openai_pool = AsyncOpenAIPool(
+    api_key=os.getenv('OPENAI_API_KEY'),
+    limits=httpx.Limits(
+        max_connections=int(os.getenv('OPENAI_MAX_CONNECTIONS', 100)),
+        max_keepalive_connections=int(os.getenv('OPENAI_MAX_KEEPALIVE', 20)),
+        keepalive_expiry=float(os.getenv('OPENAI_KEEPALIVE_EXPIRY', 30))
+    ),
+    timeout=openai_timeout,
+    http2=os.getenv('OPENAI_HTTP2', 'true').lower() == 'true'
+)
+
+class CircuitOpenError(Exception):
+    """Raised without calling OpenAI while the circuit breaker is open"""
+
+class CircuitBreaker:
+    """Fail fast after repeated upstream failures, then let one trial call through.
+
+    Opens after ``failure_threshold`` consecutive failures. Once
+    ``reset_seconds`` have passed, a single trial call is allowed: success
+    closes the circuit, failure re-opens it for another ``reset_seconds``.
+    """
+
+    def __init__(self, failure_threshold=5, reset_seconds=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def state(self):
+        with self._lock:
+            if self.opened_at is None:
+                return 'closed'
+            if time.monotonic() - self.opened_at < self.reset_seconds:
+                return 'open'
+            return 'half-open'
+
+    def allow(self):
+        """Whether a call may go upstream now"""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_seconds or self.trial_in_flight:
+                return False
+            self.trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        """Count an upstream failure; returns True if it opened a closed circuit"""
+        with self._lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.opened_at is None and self.failures < self.failure_threshold:
+                return False
+            was_closed = self.opened_at is None
+            self.opened_at = time.monotonic()
+            return was_closed
+
+    def release_trial(self):
+        """Give up the trial call without an outcome (e.g. it was cancelled)"""
+        with self._lock:
+            self.trial_in_flight = False
+
+class ResilientOpenAIClient:
+    """OpenAI chat completions (on an AsyncOpenAI client) with retries, backoff and a circuit breaker.
+
+    Rate limits, timeouts, connection errors and 5xx responses are retried
+    with full-jitter exponential backoff, or after the server's Retry-After
+    when it sends one. Each attempt gets its own timeout. For streamed
+    completions only opening the stream is retried; an error mid-stream is
+    raised to the caller, who has already seen part of the output.
+    """
+
+    RETRYABLE_STATUS = frozenset({408, 409, 429})
+
+    def __init__(self, client, max_attempts=4, base_delay=0.5, max_delay=20.0,
+                 max_retry_after=60.0, attempt_timeout=None, breaker=None):
+        self.client = client
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.attempt_timeout = attempt_timeout
+        self.breaker = breaker or CircuitBreaker()
+        self.counters = Counter()
+        self._lock = threading.Lock()
+
+    def count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    @classmethod
+    def is_retryable(cls, error):
+        if isinstance(error, openai.APIConnectionError):  # includes APITimeoutError
+            return True
+        if isinstance(error, openai.APIStatusError):
+            if getattr(error, 'code', None) == 'insufficient_quota':
+                return False
+            return error.status_code in cls.RETRYABLE_STATUS or error.status_code >= 500
+        return False
+
+    @staticmethod
+    def retry_after(error):
+        """Seconds the server asked us to wait (Retry-After / retry-after-ms), if any"""
+        response = getattr(error, 'response', None)
+        if response is None:
+            return None
+        try:
+            if response.headers.get('retry-after-ms'):
+                return float(response.headers['retry-after-ms']) / 1000
+            value = response.headers.get('retry-after')
+            if not value:
+                return None
+            try:
+                return max(float(value), 0.0)
+            except ValueError:
+                retry_at = parsedate_to_datetime(value)
+                return max((retry_at - datetime.now(retry_at.tzinfo)).total_seconds(), 0.0)
+        except (TypeError, ValueError):
+            return None
+
+    def backoff(self, attempt, error):
+        retry_after = self.retry_after(error)
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def record_error(self, error):
+        if isinstance(error, openai.APITimeoutError):
+            self.count('timeouts')
+        elif isinstance(error, openai.APIConnectionError):
+            self.count('connection_errors')
+        elif error.status_code == 429:
+            self.count('rate_limited')
+        else:
+            self.count('server_errors')
+        if self.breaker.record_failure():
+            self.count('circuit_opens')
+            print(f"❌ OpenAI circuit breaker opened for {self.breaker.reset_seconds}s")
+
+    async def create_chat_completion(self, **kwargs):
+        """chat.completions.create() with retries; raises CircuitOpenError when failing fast"""
+        self.count('calls')
+        if self.attempt_timeout is not None:
+            kwargs.setdefault('timeout', self.attempt_timeout)
+        for attempt in range(self.max_attempts):
+            if not self.breaker.allow():
+                self.count('circuit_rejections')
+                self.count('failures')
+                raise CircuitOpenError("OpenAI is unavailable (circuit breaker open)")
+            self.count('attempts')
+            settled = False
+            try:
+                response = await self.client.chat.completions.create(**kwargs)
+                settled = True
+            except Exception as e:
+                settled = True
+                if not self.is_retryable(e):
+                    # OpenAI answered; the request itself was rejected
+                    self.breaker.record_success()
+                    self.count('failures')
+                    raise
+                self.record_error(e)
+                delay = self.backoff(attempt, e)
+                if attempt + 1 >= self.max_attempts or delay > self.max_retry_after:
+                    self.count('failures')
+                    raise
+                self.count('retries')
+                print(f"OpenAI call failed ({e.__class__.__name__}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+            else:
+                self.breaker.record_success()
+                self.count('successes')
+                return response
+            finally:
+                if not settled:
+                    # Cancelled mid-call (CancelledError is not an Exception); a held
+                    # trial would keep the circuit from ever closing again
+                    self.breaker.release_trial()
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.counters)
+        return {**counters, 'circuit': self.breaker.state()}
+
+openai_api = ResilientOpenAIClient(
+    openai_pool.client,
+    max_attempts=int(os.getenv('OPENAI_MAX_ATTEMPTS', 4)),
+    base_delay=float(os.getenv('OPENAI_BACKOFF_BASE', 0.5)),
+    max_delay=float(os.getenv('OPENAI_BACKOFF_MAX', 20)),
+    max_retry_after=float(os.getenv('OPENAI_MAX_RETRY_AFTER', 60)),
+    attempt_timeout=openai_timeout,
+    breaker=CircuitBreaker(
+        failure_threshold=int(os.getenv('OPENAI_CIRCUIT_FAILURES', 5)),
+        reset_seconds=float(os.getenv('OPENAI_CIRCUIT_RESET', 30))
+    )
+)
+
 # Initialize AWS S3 client
 try:
     s3_client = boto3.client(
@@ -85,19 +568,110 @@ except Exception as e:
     print("❌ AWS S3 Connection Error:", e)
     s3_client = None
 
-def get_feedback_context(paper_id):
-    """Get relevant feedback for a paper to improve question generation"""
+# Per-school PDF themes, e.g. PDF_THEMES='{"dps": {"title": {"textColor": "#8b0000"}}}'
+try:
+    for theme_name, overrides in json.loads(os.getenv('PDF_THEMES', '{}')).items():
+        register_pdf_theme(theme_name, overrides)
+except Exception as e:
+    print("❌ Error loading PDF_THEMES:", e)
+
+# Note uploads stream to S3 in parts; memory per upload ~ part size x (concurrency + 1)
+NOTE_UPLOAD_MAX_BYTES = int(os.getenv('NOTE_UPLOAD_MAX_MB', 200)) * 1024 * 1024
+NOTE_UPLOAD_PART_SIZE = max(int(os.getenv('NOTE_UPLOAD_PART_MB', 8)), 5) * 1024 * 1024  # S3 minimum is 5 MB
+NOTE_UPLOAD_CONCURRENCY = int(os.getenv('NOTE_UPLOAD_CONCURRENCY', 4))
+note_upload_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('NOTE_UPLOAD_WORKERS', 16)),
+    thread_name_prefix='note-upload'
+)
+# Reject oversized bodies before Werkzeug spools them
+app.config['MAX_CONTENT_LENGTH'] = NOTE_UPLOAD_MAX_BYTES + 1024 * 1024
+
+# Topic generation fan-out: per-request limit and a shared worker pool
+TOPIC_CONCURRENCY = int(os.getenv('TOPIC_CONCURRENCY', 4))
+TOPIC_WORKERS = int(os.getenv('TOPIC_WORKERS', 16))
+topic_executor = ThreadPoolExecutor(max_workers=TOPIC_WORKERS, thread_name_prefix='topic')
+
+# Prompt and completion token budgets for the chat model
+OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-3.5-turbo')
+MODEL_CONTEXT_TOKENS = int(os.getenv('MODEL_CONTEXT_TOKENS', 16385))
+MAX_COMPLETION_TOKENS = int(os.getenv('MAX_COMPLETION_TOKENS', 4096))
+MIN_COMPLETION_TOKENS = 256
+FEEDBACK_CONTEXT_TOKENS = int(os.getenv('FEEDBACK_CONTEXT_TOKENS', 500))
+# Chat message framing plus the system message
+MESSAGE_OVERHEAD_TOKENS = 32
+# Typical size of one generated question (text, options, answer, explanation) as JSON
+QUESTION_TOKENS = {'MCQ': 180, 'Short': 150, 'Long': 400, 'Fill Blanks': 110}
+DEFAULT_QUESTION_TOKENS = 200
+COMPLETION_OVERHEAD_TOKENS = 30
+COMPLETION_HEADROOM = 1.25
+
+@functools.lru_cache(maxsize=None)
+def get_token_encoding(model=OPENAI_MODEL):
+    """The tokenizer for ``model``, or None when tiktoken (or its encoding files) is unavailable"""
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding('cl100k_base')
+    except Exception as e:
+        print(f"Tokenizer unavailable, estimating token counts: {e}")
+        return None
+
+def count_tokens(text):
+    """Tokens in ``text`` for OPENAI_MODEL, estimated if there is no tokenizer"""
+    encoding = get_token_encoding()
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+def trim_to_tokens(text, max_tokens):
+    """The longest prefix of ``text`` that fits in ``max_tokens``"""
+    if max_tokens <= 0:
+        return ''
+    encoding = get_token_encoding()
+    if encoding is None:
+        return text[:max_tokens * 4]
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
+
+def completion_token_budget(topic_data):
+    """max_tokens for a topic: room for numQuestions questions of its type, with headroom"""
+    try:
+        num_questions = max(int(topic_data.get('numQuestions', 1)), 1)
+    except (TypeError, ValueError):
+        num_questions = 1
+    per_question = QUESTION_TOKENS.get(topic_data.get('questionType'), DEFAULT_QUESTION_TOKENS)
+    budget = math.ceil((COMPLETION_OVERHEAD_TOKENS + num_questions * per_question) * COMPLETION_HEADROOM)
+    return max(MIN_COMPLETION_TOKENS, min(budget, MAX_COMPLETION_TOKENS))
+
+def get_feedback_context(paper_id, max_tokens=None):
+    """Get relevant feedback for a paper to improve question generation.
+
+    With ``max_tokens``, the newest feedback is kept and older entries are dropped.
+    """
     try:
         feedback = list(feedback_collection.find(
             {'paper_id': paper_id},
             {'_id': 0, 'feedback': 1, 'suggestions': 1}
-        ))
-        if feedback:
-            feedback_text = "\n".join([
-                f"Feedback: {f['feedback']}\nSuggestions: {f['suggestions']}"
-                for f in feedback
-            ])
-            return f"\nPrevious feedback to consider:\n{feedback_text}"
+        ).sort('created_at', DESCENDING))
+        header = "\nPrevious feedback to consider:\n"
+        budget = None if max_tokens is None else max_tokens - count_tokens(header)
+        entries = []
+        for f in feedback:
+            entry = f"Feedback: {f['feedback']}\nSuggestions: {f['suggestions']}"
+            if budget is not None:
+                tokens = count_tokens(entry) + 1
+                if tokens > budget:
+                    break
+                budget -= tokens
+            entries.append(entry)
+        if entries:
+            feedback_text = "\n".join(reversed(entries))
+            return f"{header}{feedback_text}"
         return ""
     except Exception as e:
         print(f"Error getting feedback: {e}")
@@ -105,19 +679,61 @@ def get_feedback_context(paper_id):
     
 
 
-def generate_question_prompt(topic_data, paper_id=None, note_id=None):
-    """Enhanced prompt generation with note context"""
-    feedback_context = get_feedback_context(paper_id) if paper_id else ""
+def generate_question_prompt(topic_data, paper_id=None, note_id=None, max_tokens=None):
+    """Enhanced prompt generation with note context, fitted to the model's context window.
+
+    The instructions always go in. Whatever the context window has left after
+    them and the ``max_tokens`` reserved for the completion goes to feedback
+    first, then to note context, each within its own cap.
+    """
+    max_tokens = completion_token_budget(topic_data) if max_tokens is None else max_tokens
+    available = (MODEL_CONTEXT_TOKENS - max_tokens - MESSAGE_OVERHEAD_TOKENS
+                 - count_tokens(render_question_prompt(topic_data)))
+
+    feedback_context = ""
+    if paper_id:
+        feedback_context = get_feedback_context(paper_id, min(FEEDBACK_CONTEXT_TOKENS, available))
+        available -= count_tokens(feedback_context)
+
     note_context = ""
-    
     if note_id:
         try:
-            note = db['notes'].find_one({'_id': ObjectId(note_id)})
-            if note and note.get('text_content'):
-                note_context = f"\nContext from uploaded notes:\n{note['text_content']}\n"
+            # Only the chunks most relevant to this topic, within the remaining budget
+            query = ' '.join([
+                topic_data['sectionName'],
+                topic_data.get('topicNotes', ''),
+                topic_data.get('additionalInstructions', '')
+            ])
+            header = "\nContext from uploaded notes:\n"
+            note_budget = min(NOTE_CONTEXT_TOKENS, available - count_tokens(header))
+            note_text = select_note_context(note_id, query, note_budget)
+            if note_text:
+                note_context = f"{header}{note_text}\n"
+            elif note_budget > 0 and note_text_status(note_id) == 'failed':
+                print(f"Text extraction failed for note {note_id}; generating without it")
+            elif note_budget > 0:
+                print(f"No extracted text yet for note {note_id}")
         except Exception as e:
             print(f"Error getting note context: {e}")
-    
+
+    return render_question_prompt(topic_data, note_context, feedback_context)
+
+def render_question_prompt(topic_data, note_context="", feedback_context=""):
+    """The question generation prompt for a topic with the given context sections"""
+    batch_note = ""
+    if topic_data.get('batchCount'):
+        batch_note = (
+            f"This is part {topic_data['batchPart']} of {topic_data['batchCount']} of a "
+            f"{topic_data['totalQuestions']}-question set generated separately; "
+            f"cover different aspects of the topic so the parts do not overlap.\n"
+        )
+    similar_note = ""
+    if topic_data.get('similarQuestions'):
+        listed = '\n'.join(f"- {text}" for text in topic_data['similarQuestions'])
+        similar_note = (
+            "Questions already written for a closely related topic (use them as a guide to "
+            f"the syllabus, but do not repeat or rephrase them):\n{listed}\n"
+        )
     return f"""You are an expert educator tasked to create questions.
 
 Generate {topic_data['numQuestions']} {topic_data['questionType']} questions for:
@@ -132,7 +748,8 @@ Generate {topic_data['numQuestions']} {topic_data['questionType']} questions for
 
 {note_context}
 
-Additional Instructions: {topic_data['additionalInstructions']}
+Additional Instructions: {topic_data.get('additionalInstructions', '')}
+{batch_note}{similar_note}
 
 {feedback_context}
 🔵 Strict Requirements:
@@ -166,118 +783,6 @@ Example:
 }}
 """
 
-def create_pdf(questions, filename, subject_name, class_grade):
-    # Create PDF in memory
-    pdf_buffer = io.BytesIO()
-    doc = SimpleDocTemplate(pdf_buffer, pagesize=letter)
-    styles = getSampleStyleSheet()
-    story = []
-    
-    # Define custom styles
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Heading1'],
-        fontSize=20,
-        spaceAfter=30,
-        alignment=1,  # Center alignment
-        textColor='#2c3e50'  # Dark blue color
-    )
-    
-    header_style = ParagraphStyle(
-        'HeaderStyle',
-        parent=styles['Heading2'],
-        fontSize=14,
-        spaceAfter=20,
-        textColor='#34495e'  # Slightly lighter blue
-    )
-    
-    question_style = ParagraphStyle(
-        'QuestionStyle',
-        parent=styles['Normal'],
-        fontSize=12,
-        spaceAfter=10,
-        textColor='#2c3e50',
-        backColor='#f8f9fa',  # Light gray background
-        borderPadding=5,
-        borderColor='#dee2e6',
-        borderWidth=1
-    )
-    
-    option_style = ParagraphStyle(
-        'OptionStyle',
-        parent=styles['Normal'],
-        fontSize=11,
-        leftIndent=20,
-        spaceAfter=5,
-        textColor='#495057'
-    )
-    
-    answer_style = ParagraphStyle(
-        'AnswerStyle',
-        parent=styles['Normal'],
-        fontSize=12,
-        spaceAfter=10,
-        textColor='#28a745',  # Green color for answers
-        backColor='#e8f5e9',  # Light green background
-        borderPadding=5,
-        borderColor='#c8e6c9',
-        borderWidth=1
-    )
-    
-    explanation_style = ParagraphStyle(
-        'ExplanationStyle',
-        parent=styles['Normal'],
-        fontSize=11,
-        spaceAfter=20,
-        textColor='#6c757d',
-        leftIndent=20
-    )
-    
-    # Add title and paper details
-    story.append(Paragraph("QUESTION PAPER", title_style))
-    
-    # Add paper details
-    details = [
-        f"<b>Class:</b> {class_grade}",
-        f"<b>Subject:</b> {subject_name}",
-        f"<b>Total Questions:</b> {sum(len(topic['questions']) for topic in questions)}"
-    ]
-    
-    for detail in details:
-        story.append(Paragraph(detail, styles['Normal']))
-        story.append(Spacer(1, 5))
-    
-    story.append(Spacer(1, 20))
-    
-    # Add questions
-    for i, topic in enumerate(questions, 1):
-        # Add topic header
-        story.append(Paragraph(f"Topic {i}: {topic['topic']}", header_style))
-        story.append(Spacer(1, 10))
-        
-        # Add questions
-        for j, q in enumerate(topic['questions'], 1):
-            # Question text
-            story.append(Paragraph(f"Q{j}. {q['question']}", question_style))
-            
-            # Options (if MCQ)
-            if 'options' in q:
-                for opt in q['options']:
-                    story.append(Paragraph(f"• {opt}", option_style))
-            
-            # Answer
-            story.append(Paragraph(f"<b>Answer:</b> {q['answer']}", answer_style))
-            
-            # Explanation
-            story.append(Paragraph(f"<b>Explanation:</b> {q['explanation']}", explanation_style))
-            
-            # Add spacing between questions
-            story.append(Spacer(1, 15))
-    
-    doc.build(story)
-    pdf_buffer.seek(0)
-    return pdf_buffer
-
 @app.route('/')
 def serve():
     return send_from_directory(app.static_folder, 'index.html')
@@ -299,197 +804,1658 @@ def generate_cache_key(topic_data):
         'bloom': topic_data['bloomLevel'],
         'intelligence': topic_data['intelligenceType']
     }
+    if topic_data.get('noteId'):
+        key_data['note'] = topic_data['noteId']
     return hashlib.md5(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
 
-def generate_questions_for_topic(topic_data, previous_paper_id=None):
-    """Generate questions for a single topic with caching"""
+class TTLCache:
+    """Bounded in-process LRU cache with per-entry TTL"""
+
+    def __init__(self, max_size=512, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self.evictions += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def get_many(self, keys):
+        """Return {key: value} for the keys that are cached and fresh"""
+        found = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+# Topic questions keyed by generate_cache_key()
+topic_cache = TTLCache(
+    max_size=int(os.getenv('QUESTION_CACHE_SIZE', 512)),
+    ttl=int(os.getenv('QUESTION_CACHE_TTL', 3600))
+)
+
+class SingleFlight:
+    """Coalesce concurrent calls with the same key into a single execution"""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.followers = 0
+
+    def do(self, key, fn):
+        """Run fn() once per key at a time; concurrent callers share its outcome.
+
+        Returns a ``(result, shared)`` tuple where ``shared`` is True for callers
+        that waited on another caller's execution.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+                self.leaders += 1
+            else:
+                self.followers += 1
+
+        if not leader:
+            return future.result(), True
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': len(self._calls),
+                'leaders': self.leaders,
+                'followers': self.followers
+            }
+
+topic_flights = SingleFlight()
+
+def generate_questions_for_topic(topic_data, previous_paper_id=None, on_question=None):
+    """Generate questions for a single topic with caching.
+
+    ``on_question`` is called with each question as it streams in from
+    OpenAI; it is not called for cache hits or coalesced requests.
+    """
     try:
         print(f"\nGenerating questions for topic: {topic_data['sectionName']}")
         print(f"Topic data: {json.dumps(topic_data, indent=2)}")
 
-        # Check cache first
-        cache_key = generate_cache_key(topic_data)
-        cached_questions = papers_collection.find_one(
-            {
-                'cache_key': cache_key,
-                'created_at': {
-                    '$gte': (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d %H:%M:%S')
+        # Check the in-process cache first
+        cache_key = generate_cache_key(topic_data)
+        memory_questions = topic_cache.get(cache_key)
+        if memory_questions is not None:
+            print(f"Memory cache hit for topic: {topic_data['sectionName']}")
+            return {
+                'topic': topic_data['sectionName'],
+                'questions': list(memory_questions),
+                'cached': True
+            }
+
+        # Identical in-flight requests wait on one Mongo lookup / OpenAI call
+        result, shared = topic_flights.do(
+            cache_key,
+            lambda: load_or_generate_topic(topic_data, cache_key, previous_paper_id, on_question)
+        )
+        if shared:
+            print(f"Joined in-flight generation for topic: {topic_data['sectionName']}")
+            return {**result, 'questions': list(result['questions'])}
+        return result
+    except Exception as e:
+        print(f"Error generating questions for topic {topic_data['sectionName']}: {str(e)}")
+        print("Full error details:", e.__dict__)
+        raise
+
+class QuestionStreamParser:
+    """Incrementally extract complete objects from the ``"questions"`` array.
+
+    Feed completion text as it arrives; each call to feed() returns the
+    question dicts whose closing brace has been seen. Anything before the
+    first ``{`` (prose, code fences) is ignored. Deltas are kept as a list
+    and joined only when a question or key is complete; once a question has
+    been parsed, text before the one being read is dropped.
+    """
+
+    def __init__(self):
+        self.parts = []  # the text from self.offset on
+        self.offset = 0
+        self.position = 0
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.string_start = None
+        self.last_key = None
+        self.array_depth = None
+        self.object_start = None
+        self.started = False
+        self.count = 0
+
+    @property
+    def content(self):
+        """The text fed so far (all of it until a question has been parsed)"""
+        joined = ''.join(self.parts)
+        self.parts = [joined]
+        return joined
+
+    def slice(self, start, end):
+        return self.content[start - self.offset:end - self.offset]
+
+    def feed(self, text):
+        self.parts.append(text)
+        questions = []
+        for i, char in enumerate(text, self.position):
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == '\\':
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+                    if self.depth == 1:
+                        self.last_key = self.slice(self.string_start + 1, i)
+                continue
+            if not self.started:
+                if char == '{':
+                    self.started = True
+                    self.depth = 1
+                continue
+            if char == '"':
+                self.in_string = True
+                self.string_start = i
+            elif char in '{[':
+                if char == '[' and self.depth == 1 and self.last_key == 'questions':
+                    self.array_depth = 2
+                elif char == '{' and self.array_depth is not None and self.depth == self.array_depth:
+                    self.object_start = i
+                self.depth += 1
+            elif char in '}]':
+                self.depth -= 1
+                if char == '}' and self.object_start is not None and self.depth == self.array_depth:
+                    questions.append(json.loads(self.slice(self.object_start, i + 1)))
+                    self.object_start = None
+                elif char == ']' and self.depth == 1:
+                    self.array_depth = None
+        self.position += len(text)
+        self.count += len(questions)
+        if self.count:
+            # content is no longer needed as a fallback; keep only a question
+            # or key that is still being read
+            if self.object_start is not None:
+                keep = self.object_start
+            elif self.in_string and self.depth == 1:
+                keep = self.string_start
+            else:
+                keep = self.position
+            if keep > self.offset:
+                self.parts = [self.content[keep - self.offset:]] if keep < self.position else []
+                self.offset = keep
+        return questions
+
+def stream_questions(prompt, max_tokens=MAX_COMPLETION_TOKENS):
+    """Call OpenAI in streaming mode and yield each question once it is complete.
+
+    The request runs on the shared async OpenAI pool. Closing the generator
+    early closes the upstream stream, which stops token generation (and
+    billing) for a bad completion.
+    """
+    return openai_pool.iterate(astream_questions(prompt, max_tokens))
+
+# JSON mode makes the model return a bare JSON object: no prose or code fences
+OPENAI_JSON_MODE = os.getenv('OPENAI_JSON_MODE', 'true').lower() == 'true'
+
+def chat_completion_request(prompt, max_tokens=MAX_COMPLETION_TOKENS):
+    """Chat completion parameters for a question prompt (also the Batch API request body)"""
+    params = {
+        'model': OPENAI_MODEL,
+        'messages': [
+            {"role": "system", "content": "You are an expert educational question generator."},
+            {"role": "user", "content": prompt}
+        ],
+        'temperature': 0.7,
+        'max_tokens': max_tokens
+    }
+    if OPENAI_JSON_MODE:
+        params['response_format'] = {'type': 'json_object'}
+    return params
+
+async def astream_questions(prompt, max_tokens=MAX_COMPLETION_TOKENS):
+    """Async generator behind stream_questions()"""
+    stream = await openai_api.create_chat_completion(
+        **chat_completion_request(prompt, max_tokens),
+        stream=True
+    )
+    parser = QuestionStreamParser()
+    try:
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            if chunk.choices[0].finish_reason == 'length':
+                print(f"OpenAI completion hit max_tokens={max_tokens}; trailing question dropped")
+            if not chunk.choices[0].delta.content:
+                continue
+            for question in parser.feed(chunk.choices[0].delta.content):
+                yield question
+
+        if parser.count == 0:
+            # Not the expected shape; fall back to parsing the whole completion
+            content = parser.content
+            try:
+                questions = json.loads(content)
+            except json.JSONDecodeError as e:
+                print(f"Error parsing OpenAI response: {str(e)}")
+                print(f"Raw response content: {content}")
+                raise
+            for question in questions['questions']:
+                yield question
+    finally:
+        await stream.close()
+
+def parse_completion_questions(content, question_type=None):
+    """Valid (repaired) questions from a complete, non-streamed completion; invalid ones are dropped"""
+    parser = QuestionStreamParser()
+    questions = parser.feed(content)
+    if not questions:
+        questions = json.loads(content)['questions']
+    valid = []
+    for question in questions:
+        question, errors = repair_question(question, question_type)
+        if errors:
+            print(f"Dropped invalid question ({'; '.join(errors)}): {question!r}")
+        else:
+            valid.append(question)
+    return valid
+
+# Field names the model sometimes uses instead of ours
+QUESTION_FIELD_ALIASES = {
+    'question_text': 'question',
+    'choices': 'options',
+    'correct_answer': 'answer',
+    'correctanswer': 'answer',
+    'correct_option': 'answer',
+    'explaination': 'explanation',
+    'rationale': 'explanation',
+    'reason': 'explanation',
+    'solution': 'explanation'
+}
+# "A) ", "(b) ", "C. ", "Option D: " in front of an option or answer
+OPTION_LABEL = re.compile(r'^\s*(?:option\s+)?(?:\(([A-Da-d])\)\s*|([A-Da-d])\s*[).:]\s+)', re.IGNORECASE)
+# An answer given only as the option's letter
+ANSWER_LETTER = re.compile(r'^\s*(?:option\s+)?\(?([A-Da-d])\)?[).:]?\s*$', re.IGNORECASE)
+
+def normalize_option(text):
+    return ' '.join(str(text).lower().split()).rstrip('.')
+
+def option_label_index(label):
+    """Position (A=0) of the option an OPTION_LABEL match names"""
+    return ord((label.group(1) or label.group(2)).upper()) - ord('A')
+
+def strip_option_labels(options):
+    """Drop "A)"-style labels, but only when every option has one and they run A, B, C, D in order.
+
+    Otherwise the options are returned unchanged: "C. elegans" or "a. m."
+    is option text that merely looks like a label.
+    """
+    labels = [OPTION_LABEL.match(option) for option in options]
+    if not options or not all(labels) or [option_label_index(label) for label in labels] != list(range(len(options))):
+        return options
+    return [option[label.end():].strip() for option, label in zip(options, labels)]
+
+def match_option(answer, options):
+    """The option an answer refers to (by text, labelled text or letter), or None"""
+    wanted = normalize_option(answer)
+    for option in options:
+        if normalize_option(option) == wanted:
+            return option
+    # "B) Paris" only counts if Paris is option B
+    label = OPTION_LABEL.match(answer)
+    if label:
+        index = option_label_index(label)
+        if index < len(options) and normalize_option(answer[label.end():]) == normalize_option(options[index]):
+            return options[index]
+    letter = ANSWER_LETTER.match(answer)
+    if letter and ord(letter.group(1).upper()) - ord('A') < len(options):
+        return options[ord(letter.group(1).upper()) - ord('A')]
+    return None
+
+def repair_question(question, question_type=None):
+    """Fix common slips in a generated question and validate it; returns (question, errors).
+
+    Every question needs question, answer and explanation text. MCQs (or,
+    without a type, questions with options) need exactly 4 distinct options
+    and an answer that is one of them. Repairs: aliased or mis-cased field
+    names, options given as a dict or text block, "A)"-style labels (when
+    all four options carry them, A to D), and answers given as a letter or
+    with different case or spacing.
+    """
+    if not isinstance(question, dict):
+        return question, ['not a JSON object']
+
+    fixed = {}
+    for key, value in question.items():
+        name = str(key).strip().lower().replace(' ', '_')
+        fixed.setdefault(QUESTION_FIELD_ALIASES.get(name, name), value)
+    for field in ('question', 'answer', 'explanation'):
+        if isinstance(fixed.get(field), (int, float)):
+            fixed[field] = str(fixed[field])
+        if isinstance(fixed.get(field), str):
+            fixed[field] = fixed[field].strip()
+
+    options = fixed.get('options')
+    if isinstance(options, dict):
+        options = list(options.values())
+    elif isinstance(options, str):
+        options = options.splitlines()
+    if isinstance(options, list):
+        options = strip_option_labels([str(option).strip() for option in options])
+        options = list(dict.fromkeys(option for option in options if option))
+        fixed['options'] = options
+
+    errors = [
+        f"missing {field}" for field in ('question', 'answer', 'explanation')
+        if not isinstance(fixed.get(field), str) or not fixed[field]
+    ]
+    is_mcq = question_type == 'MCQ' if question_type else 'options' in fixed
+    if is_mcq:
+        if not isinstance(options, list) or len(options) != 4:
+            errors.append(f"expected 4 options, got {len(options) if isinstance(options, list) else 0}")
+        elif 'missing answer' not in errors:
+            answer = match_option(fixed['answer'], options)
+            if answer is None:
+                errors.append("answer is not one of the options")
+            else:
+                fixed['answer'] = answer
+    return fixed, errors
+
+# Topics too big for one completion are split into batches generated concurrently
+QUESTION_BATCH_SIZE = int(os.getenv('QUESTION_BATCH_SIZE', 10))
+QUESTION_BATCH_WORKERS = int(os.getenv('QUESTION_BATCH_WORKERS', 16))
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv('NEAR_DUPLICATE_THRESHOLD', 0.8))
+# Separate from topic_executor, whose tasks block waiting on their batches
+batch_executor = ThreadPoolExecutor(max_workers=QUESTION_BATCH_WORKERS, thread_name_prefix='question-batch')
+
+def questions_per_batch(question_type):
+    """Most questions of a type that fit in one completion, capped at QUESTION_BATCH_SIZE"""
+    per_question = QUESTION_TOKENS.get(question_type, DEFAULT_QUESTION_TOKENS)
+    fits = int((MAX_COMPLETION_TOKENS / COMPLETION_HEADROOM - COMPLETION_OVERHEAD_TOKENS) // per_question)
+    return max(1, min(QUESTION_BATCH_SIZE, fits))
+
+def split_topic_batches(topic_data):
+    """Split a topic into near-equal batches; a topic that fits one batch is returned as is"""
+    try:
+        num_questions = int(topic_data.get('numQuestions', 1))
+    except (TypeError, ValueError):
+        return [topic_data]
+    batch_size = questions_per_batch(topic_data.get('questionType'))
+    if num_questions <= batch_size:
+        return [topic_data]
+
+    count = math.ceil(num_questions / batch_size)
+    return [
+        {
+            **topic_data,
+            'numQuestions': num_questions // count + (1 if i < num_questions % count else 0),
+            'batchPart': i + 1,
+            'batchCount': count,
+            'totalQuestions': num_questions
+        }
+        for i in range(count)
+    ]
+
+class QuestionDeduper:
+    """Accepts questions unless their wording nearly repeats an accepted one.
+
+    Similarity is the Jaccard index of the questions' words; numbers and
+    single letters count, so "x + 3 = 5" and "x + 4 = 6" stay distinct.
+    """
+
+    def __init__(self, threshold=NEAR_DUPLICATE_THRESHOLD):
+        self.threshold = threshold
+        self.seen = []
+
+    def add(self, question):
+        """Record the question and return True, or return False for a near-duplicate"""
+        text = ' '.join(str(question.get('question', '')).lower().split())
+        terms = (frozenset(re.findall(r'\w+', text)) - SEARCH_STOPWORDS) or frozenset([text])
+        for other in self.seen:
+            if len(terms & other) / len(terms | other) >= self.threshold:
+                return False
+        self.seen.append(terms)
+        return True
+
+# How many times a batch's invalid questions are requested again
+QUESTION_REPAIR_ATTEMPTS = int(os.getenv('QUESTION_REPAIR_ATTEMPTS', 1))
+
+def generate_question_batch(topic_data, previous_paper_id=None, on_question=None):
+    """Stream one completion's worth of questions from OpenAI into ``on_question``.
+
+    Each question is repaired and validated as it arrives. Invalid ones are
+    dropped, and only that many are requested again (up to
+    QUESTION_REPAIR_ATTEMPTS times) instead of discarding the completion.
+    """
+    request_data = topic_data
+    accepted = 0
+    for attempt in range(QUESTION_REPAIR_ATTEMPTS + 1):
+        print("Generating prompt...")
+        max_tokens = completion_token_budget(request_data)
+        prompt = generate_question_prompt(request_data, previous_paper_id, request_data.get('noteId'), max_tokens)
+        print(f"Generated prompt ({count_tokens(prompt)} tokens, max_tokens={max_tokens}). Calling OpenAI API...")
+
+        received = rejected = 0
+        try:
+            with contextlib.closing(stream_questions(prompt, max_tokens)) as streamed:
+                for question in streamed:
+                    received += 1
+                    question, errors = repair_question(question, topic_data['questionType'])
+                    if errors:
+                        rejected += 1
+                        print(f"Dropped invalid question ({'; '.join(errors)}): {question!r}")
+                        continue
+                    accepted += 1
+                    on_question(question)
+            print(f"Received {received} questions from OpenAI ({rejected} invalid)")
+        except Exception as e:
+            print(f"Error calling OpenAI API: {str(e)}")
+            raise
+
+        if not rejected or attempt == QUESTION_REPAIR_ATTEMPTS:
+            break
+        print(f"Re-requesting {rejected} questions that failed validation")
+        request_data = {**topic_data, 'numQuestions': rejected}
+
+    if not accepted:
+        raise ValueError("OpenAI response contained no valid questions")
+
+def generate_topic_questions(topic_data, previous_paper_id=None, on_question=None):
+    """Generate a topic's questions with OpenAI, in concurrent batches if it is large.
+
+    Questions are merged in arrival order, dropping near-duplicates (which
+    are not passed to ``on_question`` either). Returns ``(questions,
+    complete)``; ``complete`` is False when some, but not all, batches failed.
+    """
+    batches = split_topic_batches(topic_data)
+    deduper = QuestionDeduper()
+    # Questions seeded from a similar cached topic count as already taken
+    for text in topic_data.get('similarQuestions', []):
+        deduper.add({'question': text})
+    questions = []
+    lock = threading.Lock()
+
+    def accept(question):
+        with lock:
+            if not deduper.add(question):
+                print(f"Dropped near-duplicate question: {question.get('question')!r}")
+                return
+            questions.append(question)
+            if on_question:
+                on_question(question)
+
+    if len(batches) == 1:
+        generate_question_batch(topic_data, previous_paper_id, accept)
+        return questions, True
+
+    print(f"Splitting {topic_data['numQuestions']} questions into {len(batches)} batches")
+    futures = [
+        batch_executor.submit(generate_question_batch, batch, previous_paper_id, accept)
+        for batch in batches
+    ]
+    errors = []
+    for future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            errors.append(e)
+    if len(errors) == len(batches):
+        raise errors[0]
+    if errors:
+        print(f"{len(errors)} of {len(batches)} batches failed for topic "
+              f"{topic_data['sectionName']}: {errors[0]}")
+    return questions, not errors
+
+def find_cached_questions(cache_key):
+    """Questions for a cache key from the Mongo cache (warming the memory cache), or None"""
+    # The TTL monitor only runs once a minute, so also bound created_at here
+    cached_questions = cache_collection.find_one(
+        {
+            'cache_key': cache_key,
+            'created_at': {'$gte': datetime.utcnow() - timedelta(days=CACHE_TTL_DAYS)}
+        },
+        {'_id': 0, 'questions': 1}
+    )
+    if not cached_questions:
+        return None
+    topic_cache.set(cache_key, cached_questions['questions'])
+    return cached_questions['questions']
+
+def cache_topic_questions(topic_data, cache_key, questions):
+    """Store generated questions in the Mongo and memory caches; returns whether they were cached"""
+    # created_at is a UTC BSON date for the TTL index. Questions generated
+    # without note text that is still being extracted are not cached; a note
+    # whose extraction failed never gets text, so those are.
+    if topic_data.get('noteId') and note_text_status(topic_data['noteId']) == 'pending':
+        return False
+    topic = {field: topic_data.get(field) for field in SIMILAR_TOPIC_FIELDS}
+    cache_collection.update_one(
+        {'cache_key': cache_key},
+        {'$set': {
+            'questions': questions,
+            'topic': topic,
+            'created_at': datetime.utcnow()
+        }},
+        upsert=True
+    )
+    topic_cache.set(cache_key, questions)
+    similar_topics.add(cache_key, topic)
+    return True
+
+class MinHashIndex:
+    """Near-duplicate lookup over short texts, with MinHash signatures in a NumPy matrix.
+
+    Each text becomes the set of character 3-grams of its sorted content
+    words, so word order, case, plurals and stopwords do not matter. A query compares
+    its signature with every row at once; the fraction of equal positions
+    estimates the Jaccard similarity of the two sets. Rows are reused
+    oldest-first once ``max_size`` entries are stored.
+    """
+
+    PRIME = (1 << 31) - 1
+
+    def __init__(self, num_hashes=128, max_size=10000, seed=1):
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, self.PRIME, num_hashes, dtype=np.uint64)
+        self.b = rng.integers(0, self.PRIME, num_hashes, dtype=np.uint64)
+        self.max_size = max_size
+        self.signatures = np.zeros((max_size, num_hashes), dtype=np.uint32)
+        self.payloads = [None] * max_size
+        self.rows = {}
+        self.size = 0
+        self.next_row = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def words(text):
+        """Content words of ``text`` with simple plurals folded ("cells" -> "cell").
+
+        Digits and single letters are kept: "Chapter 1" and "Part A" are not
+        "Chapter 2" and "Part B".
+        """
+        return frozenset(
+            word[:-1] if len(word) > 3 and word.endswith('s') and not word.endswith('ss') else word
+            for word in re.findall(r'\w+', (text or '').lower())
+            if len(word) == 1 or word not in SEARCH_STOPWORDS
+        )
+
+    @classmethod
+    def shingles(cls, text):
+        words = sorted(cls.words(text))
+        padded = f" {' '.join(words)} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)} if words else set()
+
+    def signature(self, text):
+        shingles = self.shingles(text)
+        if not shingles:
+            return None
+        hashes = np.fromiter(
+            (zlib.crc32(shingle.encode('utf-8')) % self.PRIME for shingle in shingles),
+            dtype=np.uint64, count=len(shingles)
+        )
+        # a, b and the hashes are below 2**31, so a * h + b cannot overflow uint64
+        return ((np.outer(self.a, hashes) + self.b[:, None]) % self.PRIME).min(axis=1).astype(np.uint32)
+
+    def add(self, key, text, payload):
+        """Index ``text`` under ``key`` (replacing an earlier entry for the key)"""
+        signature = self.signature(text)
+        if signature is None:
+            return
+        with self._lock:
+            row = self.rows.get(key)
+            if row is None:
+                row = self.next_row
+                evicted = self.payloads[row]
+                if evicted is not None:
+                    del self.rows[evicted[0]]
+                self.next_row = (row + 1) % self.max_size
+                self.size = min(self.size + 1, self.max_size)
+                self.rows[key] = row
+            self.signatures[row] = signature
+            self.payloads[row] = (key, payload)
+
+    def query(self, text, min_similarity):
+        """``[(similarity, key, payload)]`` for entries at least ``min_similarity`` alike, best first"""
+        signature = self.signature(text)
+        if signature is None:
+            return []
+        with self._lock:
+            similarities = (self.signatures[:self.size] == signature).mean(axis=1)
+            rows = np.flatnonzero(similarities >= min_similarity)
+            matches = [(float(similarities[row]),) + self.payloads[row] for row in rows]
+        return sorted(matches, key=lambda match: -match[0])
+
+# Topic fields stored with cached questions for similar-topic lookups
+SIMILAR_TOPIC_FIELDS = (
+    'subjectName', 'classGrade', 'sectionName', 'topicNotes', 'questionType',
+    'difficulty', 'bloomLevel', 'intelligenceType', 'noteId'
+)
+# Fields that must match (ignoring case and spacing) to serve a similar topic's questions
+SIMILAR_SERVE_FIELDS = ('questionType', 'difficulty', 'bloomLevel', 'intelligenceType')
+SIMILAR_TOPICS_ENABLED = os.getenv('SIMILAR_TOPICS', 'true').lower() == 'true'
+SIMILAR_SERVE_THRESHOLD = float(os.getenv('SIMILAR_SERVE_THRESHOLD', 0.9))
+SIMILAR_SEED_THRESHOLD = float(os.getenv('SIMILAR_SEED_THRESHOLD', 0.3))
+SIMILAR_SEED_QUESTIONS = int(os.getenv('SIMILAR_SEED_QUESTIONS', 5))
+
+class SimilarTopicIndex:
+    """Finds cached topics worded like a new request, beyond exact cache keys.
+
+    A topic with the same content words (ignoring case, order, plurals and
+    stopwords: "Cells" for "cell", "Algebra basics" for "Basics of Algebra")
+    and the same subject, class, note and question settings is served from
+    the cache. Character 3-grams alone would also match "Reflection of light"
+    to "Refraction of light", so the signature only pre-selects candidates. A looser match within
+    the same subject, class and note, e.g. the same topic at another
+    difficulty, seeds the prompt with a few of its questions, which the new
+    topic must not repeat. Loaded lazily from the Mongo cache.
+    """
+
+    def __init__(self, max_size=10000):
+        self.index = MinHashIndex(max_size=max_size)
+        self.loaded = False
+        self.served = 0
+        self.seeded = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def text(topic):
+        return f"{topic.get('sectionName') or ''} {topic.get('topicNotes') or ''}"
+
+    @staticmethod
+    def same(topic, other, fields):
+        def clean(value):
+            return ' '.join(str(value or '').lower().split())
+        return all(clean(topic.get(field)) == clean(other.get(field)) for field in fields)
+
+    def add(self, cache_key, topic):
+        self.index.add(cache_key, self.text(topic), topic)
+
+    def load(self):
+        with self._lock:
+            if self.loaded:
+                return
+            self.loaded = True
+            entries = cache_collection.find(
+                {
+                    'topic': {'$exists': True},
+                    'created_at': {'$gte': datetime.utcnow() - timedelta(days=CACHE_TTL_DAYS)}
+                },
+                {'_id': 0, 'cache_key': 1, 'topic': 1}
+            ).sort('created_at', DESCENDING).limit(self.index.max_size)
+            # Oldest first, so the newest entries are the last to be evicted
+            for entry in reversed(list(entries)):
+                self.add(entry['cache_key'], entry['topic'])
+            print(f"Loaded {self.index.size} cached topics into the similar-topic index")
+
+    def matches(self, topic_data, cache_key, min_similarity):
+        """Similar cached topics from the same subject, class and note, best first"""
+        self.load()
+        return [
+            (similarity, key, topic)
+            for similarity, key, topic in self.index.query(self.text(topic_data), min_similarity)
+            if key != cache_key and self.same(topic_data, topic, ('subjectName', 'classGrade', 'noteId'))
+        ]
+
+    def serve(self, topic_data, cache_key):
+        """``(questions, similar topic)`` from a close enough cached topic, or None"""
+        try:
+            wanted = int(topic_data.get('numQuestions', 1))
+        except (TypeError, ValueError):
+            wanted = 1
+        for similarity, key, topic in self.matches(topic_data, cache_key, SIMILAR_SERVE_THRESHOLD):
+            if not self.same(topic_data, topic, SIMILAR_SERVE_FIELDS) \
+                    or MinHashIndex.words(self.text(topic_data)) != MinHashIndex.words(self.text(topic)):
+                continue
+            questions = topic_cache.get(key) or find_cached_questions(key)
+            if questions and len(questions) >= wanted:
+                with self._lock:
+                    self.served += 1
+                print(f"Serving '{topic_data['sectionName']}' from similar cached topic "
+                      f"'{topic['sectionName']}' (similarity {similarity:.2f})")
+                return questions, topic['sectionName']
+        return None
+
+    def seed_questions(self, topic_data, cache_key):
+        """Question texts from similar cached topics, to guide and deduplicate a new one"""
+        seeds = []
+        for similarity, key, topic in self.matches(topic_data, cache_key, SIMILAR_SEED_THRESHOLD):
+            questions = topic_cache.get(key) or find_cached_questions(key) or []
+            seeds.extend(str(q.get('question', ''))[:300] for q in questions if isinstance(q, dict))
+            if len(seeds) >= SIMILAR_SEED_QUESTIONS:
+                break
+        seeds = seeds[:SIMILAR_SEED_QUESTIONS]
+        if seeds:
+            with self._lock:
+                self.seeded += 1
+        return seeds
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self.index.size,
+                'max_size': self.index.max_size,
+                'served': self.served,
+                'seeded': self.seeded
+            }
+
+similar_topics = SimilarTopicIndex(max_size=int(os.getenv('SIMILAR_TOPIC_INDEX_SIZE', 10000)))
+
+def load_or_generate_topic(topic_data, cache_key, previous_paper_id=None, on_question=None):
+    """Serve a topic from the Mongo cache, or generate it with OpenAI and cache it"""
+    cached_questions = find_cached_questions(cache_key)
+    if cached_questions is not None:
+        print(f"Cache hit for topic: {topic_data['sectionName']}")
+        return {
+            'topic': topic_data['sectionName'],
+            'questions': cached_questions,
+            'cached': True
+        }
+
+    if SIMILAR_TOPICS_ENABLED:
+        served = similar_topics.serve(topic_data, cache_key)
+        if served:
+            questions, similar_topic = served
+            topic_cache.set(cache_key, questions)
+            return {
+                'topic': topic_data['sectionName'],
+                'questions': questions,
+                'cached': True,
+                'similar_topic': similar_topic
+            }
+        seeds = similar_topics.seed_questions(topic_data, cache_key)
+        if seeds:
+            topic_data = {**topic_data, 'similarQuestions': seeds}
+
+    questions, complete = generate_topic_questions(topic_data, previous_paper_id, on_question)
+    if not questions:
+        raise ValueError("OpenAI response contained no questions")
+
+    # Cache the results unless a batch failed
+    if complete and cache_topic_questions(topic_data, cache_key, questions):
+        print("Cached the generated questions")
+    
+    return {
+        'topic': topic_data['sectionName'],
+        'questions': questions,
+        'cached': False
+    }
+
+def topic_error_entry(topic_data, error):
+    """Result entry for a topic whose generation failed"""
+    return {
+        'topic': topic_data['sectionName'],
+        'questions': [],
+        'error': str(error)
+    }
+
+async def generate_topics_concurrently(topics, previous_paper_id=None, limit=None):
+    """Generate all topics in parallel, returning results in input order.
+
+    At most ``limit`` topics of one request are in flight at once. A failing
+    topic does not cancel the others; its entry carries an ``error`` instead.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(limit or TOPIC_CONCURRENCY)
+
+    async def run(topic_data):
+        async with semaphore:
+            return await loop.run_in_executor(
+                topic_executor, generate_questions_for_topic, topic_data, previous_paper_id
+            )
+
+    results = await asyncio.gather(*(run(t) for t in topics), return_exceptions=True)
+
+    all_questions = []
+    for topic_data, result in zip(topics, results):
+        if isinstance(result, Exception):
+            all_questions.append(topic_error_entry(topic_data, result))
+        else:
+            all_questions.append(result)
+    return all_questions
+
+def iter_topic_events(topics, previous_paper_id=None, limit=None):
+    """Yield generation events for all topics as they happen.
+
+    Events are ``('question', index, question)`` for each question streamed
+    from OpenAI and ``('topic', index, result)`` when a topic finishes. The
+    ``topic`` result is authoritative: questions already streamed can still
+    be dropped if the topic later fails. Uses the same fan-out limit and
+    per-topic error entries as generate_topics_concurrently().
+    """
+    limit = limit or TOPIC_CONCURRENCY
+    remaining = iter(enumerate(topics))
+    events = queue.Queue()
+
+    def run(index, topic_data):
+        try:
+            result = generate_questions_for_topic(
+                topic_data,
+                previous_paper_id,
+                on_question=lambda question: events.put(('question', index, question))
+            )
+        except Exception as e:
+            result = topic_error_entry(topic_data, e)
+        events.put(('topic', index, result))
+
+    def submit_next():
+        for index, topic_data in remaining:
+            topic_executor.submit(run, index, topic_data)
+            return
+
+    for _ in range(limit):
+        submit_next()
+
+    finished = 0
+    while finished < len(topics):
+        kind, index, payload = events.get()
+        if kind == 'topic':
+            finished += 1
+            submit_next()
+        yield kind, index, payload
+
+def validate_generation_request(data):
+    """Return an error message for an invalid generation request, else None"""
+    if not isinstance(data, dict):
+        return "Request body must be a JSON object"
+
+    # Validate required fields
+    required_fields = ['subjectName', 'classGrade', 'topics']
+    for field in required_fields:
+        if field not in data:
+            return f"Missing required field: {field}"
+    if not isinstance(data['topics'], list) or not data['topics']:
+        return "topics must be a non-empty list"
+
+    # Validate topic fields
+    required_topic_fields = ['sectionName', 'questionType', 'difficulty', 'bloomLevel', 'intelligenceType', 'numQuestions']
+    for i, topic in enumerate(data['topics']):
+        if not isinstance(topic, dict):
+            return f"Topic {i+1} must be a JSON object"
+        for field in required_topic_fields:
+            if not topic.get(field):
+                return f"Missing or empty required field '{field}' in topic {i+1}"
+    return None
+
+def save_generation_request(data):
+    """Store the request and return (request_id, per-topic generation inputs)"""
+    data['created_at'] = datetime.now(pytz.timezone('Asia/Kolkata')).strftime('%Y-%m-%d %H:%M:%S')
+    request_id = requests_collection.insert_one(data).inserted_id
+    print(f"Saved request to MongoDB with ID: {request_id}")
+
+    topics = [
+        {
+            **topic,
+            'subjectName': data['subjectName'],
+            'classGrade': data['classGrade']
+        }
+        for topic in data['topics']
+    ]
+    return request_id, topics
+
+def save_paper(data, request_id, all_questions):
+    """Store the generated paper and return its id"""
+    paper_data = {
+        'request_id': str(request_id),
+        'questions': all_questions,
+        'created_at': datetime.now(pytz.timezone('Asia/Kolkata')).strftime('%Y-%m-%d %H:%M:%S'),
+        'previous_paper_id': data.get('previous_paper_id'),
+        'subjectName': data['subjectName'],
+        'classGrade': data['classGrade'],
+        'theme': data.get('theme') or DEFAULT_THEME
+    }
+    paper_id = papers_collection.insert_one(paper_data).inserted_id
+    print(f"Saved generated questions to MongoDB with ID: {paper_id}")
+    return paper_id
+
+def pdf_content_key(pdf_topics, subject_name, class_grade, theme=DEFAULT_THEME):
+    """S3 key derived from a hash of everything that affects the rendered PDF"""
+    def clean(value):
+        return ' '.join(str(value).split())
+
+    normalized = {
+        'layout': PDF_LAYOUT_VERSION,
+        'theme': pdf_themes().get(theme, {}),
+        'subject': clean(subject_name),
+        'class': clean(class_grade),
+        'topics': [
+            {
+                'topic': clean(topic['topic']),
+                'questions': [
+                    {
+                        'question': clean(q['question']),
+                        'options': [clean(opt) for opt in q['options']] if 'options' in q else None,
+                        'answer': clean(q['answer']),
+                        'explanation': clean(q['explanation'])
+                    }
+                    for q in topic['questions']
+                ]
+            }
+            for topic in pdf_topics
+        ]
+    }
+    digest = hashlib.sha256(
+        json.dumps(normalized, sort_keys=True, ensure_ascii=False, separators=(',', ':')).encode()
+    ).hexdigest()
+    return f"papers/{digest}.pdf"
+
+def s3_object_exists(bucket, key):
+    """Whether the object exists; any HEAD error counts as missing.
+
+    Without s3:ListBucket, S3 answers HEAD on a missing key with 403, so a
+    role that may only Put/Get must still render and upload.
+    """
+    try:
+        s3_client.head_object(Bucket=bucket, Key=key)
+        return True
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey', 'NotFound'):
+            print(f"Could not check s3://{bucket}/{key}, treating it as missing: {e}")
+        return False
+    except Exception as e:
+        print(f"Could not check s3://{bucket}/{key}, treating it as missing: {e}")
+        return False
+
+def upload_paper_pdf(paper_id, all_questions, subject_name, class_grade, theme=DEFAULT_THEME):
+    """Render the paper PDF on the render farm, upload it to S3 and return its key.
+
+    PDFs are stored under a hash of their content, so a paper identical to an
+    earlier one reuses that object and skips both rendering and the upload.
+    """
+    pdf_topics = [t for t in all_questions if 'error' not in t]
+    pdf_filename = pdf_content_key(pdf_topics, subject_name, class_grade, theme)
+    if s3_object_exists(S3_BUCKET, pdf_filename):
+        print(f"Reusing existing PDF for paper {paper_id}: {pdf_filename}")
+        return pdf_filename
+
+    pdf_buffer = io.BytesIO(render_farm.render(pdf_topics, subject_name, class_grade, theme))
+    print("Successfully generated PDF")
+
+    # Upload to S3
+    s3_client.upload_fileobj(
+        pdf_buffer,
+        S3_BUCKET,
+        pdf_filename,
+        ExtraArgs={'ContentType': 'application/pdf'}
+    )
+    print(f"Successfully uploaded PDF to S3: {pdf_filename}")
+    return pdf_filename
+
+class RenderQueueFull(Exception):
+    """The render farm has no free slot; the caller should back off and retry"""
+
+class PdfRenderFarm:
+    """Process pool for CPU-bound ReportLab renders, with a bounded queue.
+
+    At most ``max_pending`` renders may be queued or running at once. submit()
+    waits up to ``timeout`` seconds for a slot (forever if None) and raises
+    RenderQueueFull otherwise, so callers feel backpressure instead of
+    piling work up in memory. With ``processes=0`` renders run inline.
+    """
+
+    def __init__(self, processes, max_pending):
+        self.processes = processes
+        self.max_pending = max_pending
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # spawn: forking a process full of Flask/Mongo threads is unsafe
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=register_pdf_themes,
+                    initargs=(pdf_themes(),)
+                )
+            return self._executor
+
+    def reset_executor(self):
+        """Drop a broken pool; the next render starts a fresh one"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def submit(self, questions, subject_name, class_grade, theme=DEFAULT_THEME, timeout=None):
+        """Queue a render; returns a Future resolving to the PDF bytes"""
+        if not self._slots.acquire(timeout=timeout):
+            with self._lock:
+                self.rejected += 1
+            raise RenderQueueFull(f"PDF render queue is full ({self.max_pending} pending)")
+
+        def release(_):
+            self._slots.release()
+            with self._lock:
+                self.completed += 1
+
+        with self._lock:
+            self.submitted += 1
+        if self.processes <= 0:
+            future = Future()
+            try:
+                future.set_result(render_question_paper(questions, subject_name, class_grade, theme))
+            except Exception as e:
+                future.set_exception(e)
+            release(future)
+            return future
+
+        executor = self.get_executor()
+        try:
+            future = executor.submit(render_question_paper, questions, subject_name, class_grade, theme)
+        except BrokenProcessPool:
+            self._slots.release()
+            self.reset_executor()
+            raise
+        future.add_done_callback(release)
+        return future
+
+    def render(self, questions, subject_name, class_grade, theme=DEFAULT_THEME, timeout=None):
+        """Render and wait for the PDF bytes"""
+        future = self.submit(questions, subject_name, class_grade, theme, timeout)
+        try:
+            return future.result()
+        except BrokenProcessPool:
+            # A worker died (e.g. OOM); start a fresh pool for the next render
+            self.reset_executor()
+            raise
+
+    def stats(self):
+        with self._lock:
+            return {
+                'processes': self.processes,
+                'max_pending': self.max_pending,
+                'pending': self.submitted - self.completed,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'rejected': self.rejected
+            }
+
+PDF_RENDER_PROCESSES = int(os.getenv('PDF_RENDER_PROCESSES', os.cpu_count() or 1))
+render_farm = PdfRenderFarm(
+    processes=PDF_RENDER_PROCESSES,
+    max_pending=int(os.getenv('PDF_RENDER_QUEUE', 4 * max(PDF_RENDER_PROCESSES, 1)))
+)
+PDF_RENDER_QUEUE_TIMEOUT = float(os.getenv('PDF_RENDER_QUEUE_TIMEOUT', 5))
+PAPER_EXPORT_MAX = int(os.getenv('PAPER_EXPORT_MAX', 50))
+
+# Pre-signed URLs are valid for an hour; reuse each until shortly before it expires
+PRESIGNED_URL_EXPIRES = 3600
+PRESIGNED_URL_MARGIN = int(os.getenv('PRESIGNED_URL_MARGIN', 300))
+presigned_url_cache = TTLCache(
+    max_size=int(os.getenv('PRESIGNED_URL_CACHE_SIZE', 10000)),
+    ttl=PRESIGNED_URL_EXPIRES - PRESIGNED_URL_MARGIN
+)
+
+def presigned_urls(bucket, keys):
+    """Pre-signed GET URLs for many keys at once, signing only cache misses"""
+    keys = list(dict.fromkeys(keys))
+    urls = {
+        cache_key[1]: url
+        for cache_key, url in presigned_url_cache.get_many([(bucket, key) for key in keys]).items()
+    }
+    for key in keys:
+        if key not in urls:
+            urls[key] = s3_client.generate_presigned_url(
+                'get_object',
+                Params={
+                    'Bucket': bucket,
+                    'Key': key
+                },
+                ExpiresIn=PRESIGNED_URL_EXPIRES
+            )
+            presigned_url_cache.set((bucket, key), urls[key])
+    return urls
+
+def presigned_url(bucket, key):
+    """Pre-signed GET URL for one object, reused while it has time left"""
+    return presigned_urls(bucket, [key])[key]
+
+def paper_pdf_url(pdf_key):
+    """Pre-signed download URL for a paper PDF"""
+    return presigned_url(S3_BUCKET, pdf_key)
+
+class JobQueue:
+    """Persistent job queue in Mongo, drained by local worker threads.
+
+    Jobs move queued -> running -> done | failed. A running job holds a lease;
+    if its worker dies the lease expires and any worker may reclaim it. Failed
+    and expired attempts are retried until ``max_attempts`` is reached, then
+    the job is failed; a failed attempt is requeued with ``not_before`` set
+    ``retry_seconds`` later, doubling on each attempt. A worker only records its result while it still holds
+    the claim. ``handler(job)`` does the work and returns extra fields to
+    store on the finished job; ``on_failure(job, error)``, if given, is
+    called once when a job fails for good.
+    """
+
+    def __init__(self, collection, handler, name='job', workers=2, max_attempts=3, lease_seconds=300, poll_seconds=5.0,
+                 retry_seconds=5.0, on_failure=None):
+        self.collection = collection
+        self.handler = handler
+        self.on_failure = on_failure
+        self.name = name
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.retry_seconds = retry_seconds
+        self._threads = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._changed = threading.Condition()
+
+    def start(self):
+        with self._lock:
+            if self._threads or self.workers <= 0:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self.worker_loop, args=(f"{self.name}-worker-{i}",), daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            print(f"Started {self.workers} {self.name} workers")
+
+    def enqueue(self, **payload):
+        now = datetime.utcnow()
+        job_id = self.collection.insert_one({
+            **payload,
+            'status': 'queued',
+            'attempts': 0,
+            'created_at': now,
+            'updated_at': now
+        }).inserted_id
+        self.start()
+        self._wakeup.set()
+        return job_id
+
+    def get(self, job_id):
+        return self.collection.find_one({'_id': ObjectId(job_id)})
+
+    def wait(self, job_id, timeout):
+        """Block until the job is done or failed, or the timeout passes; return the job"""
+        deadline = time.monotonic() + timeout
+        job = self.get(job_id)
+        while job and job['status'] not in ('done', 'failed'):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            # Local workers notify; poll too in case another process runs the job
+            with self._changed:
+                self._changed.wait(min(remaining, 1.0))
+            job = self.get(job_id)
+        return job
+
+    def claim(self, worker_name):
+        now = datetime.utcnow()
+        # Expired jobs with no attempts left would otherwise stay running forever
+        expired_filter = {
+            'status': 'running',
+            'lease_expires_at': {'$lt': now},
+            'attempts': {'$gte': self.max_attempts}
+        }
+        for job in self.collection.find(expired_filter):
+            error = f"Lease expired on attempt {job['attempts']} of {self.max_attempts}"
+            failed = self.collection.update_one(
+                {'_id': job['_id'], **expired_filter},
+                {'$set': {'status': 'failed', 'error': error, 'updated_at': now}, '$unset': {'lease_expires_at': ''}}
+            )
+            if failed.modified_count:
+                print(f"Failed {self.name} job {job['_id']}: {error}")
+                self.failed(job, error)
+                with self._changed:
+                    self._changed.notify_all()
+        return self.collection.find_one_and_update(
+            {'$or': [
+                # $not also matches jobs without not_before (never retried)
+                {'status': 'queued', 'not_before': {'$not': {'$gt': now}}},
+                {
+                    'status': 'running',
+                    'lease_expires_at': {'$lt': now},
+                    'attempts': {'$lt': self.max_attempts}
                 }
-            }
+            ]},
+            {
+                '$set': {
+                    'status': 'running',
+                    'worker': worker_name,
+                    'lease_expires_at': now + timedelta(seconds=self.lease_seconds),
+                    'updated_at': now
+                },
+                '$inc': {'attempts': 1}
+            },
+            sort=[('_id', ASCENDING)],
+            return_document=ReturnDocument.AFTER
         )
-        
-        if cached_questions:
-            print(f"Cache hit for topic: {topic_data['sectionName']}")
-            return {
-                'topic': topic_data['sectionName'],
-                'questions': cached_questions['questions'],
-                'cached': True
-            }
-
-        print("Generating prompt...")
-        prompt = generate_question_prompt(topic_data, previous_paper_id)
-        print("Generated prompt. Calling OpenAI API...")
 
+    def run_job(self, job):
         try:
-            response = openai_client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "You are an expert educational question generator."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.7,
-                max_tokens=1000
-            )
-            print("Received response from OpenAI")
+            update = {'status': 'done', **(self.handler(job) or {}), 'error': None}
         except Exception as e:
-            print(f"Error calling OpenAI API: {str(e)}")
-            raise
+            print(f"Error in {self.name} job {job['_id']} (attempt {job['attempts']}): {e}")
+            if job['attempts'] >= self.max_attempts:
+                update = {'status': 'failed', 'error': str(e)}
+            else:
+                # Back off so a brief S3 or Mongo outage does not use up every attempt at once
+                delay = self.retry_seconds * 2 ** (job['attempts'] - 1)
+                update = {'status': 'queued', 'error': str(e), 'not_before': datetime.utcnow() + timedelta(seconds=delay)}
+
+        update['updated_at'] = datetime.utcnow()
+        # Every claim bumps attempts, so (worker, attempts) identifies this claim;
+        # if the lease expired and another worker took the job, leave its result alone
+        result = self.collection.update_one(
+            {'_id': job['_id'], 'status': 'running', 'worker': job['worker'], 'attempts': job['attempts']},
+            {'$set': update, '$unset': {'lease_expires_at': ''}}
+        )
+        if not result.matched_count:
+            print(f"Dropped result of {self.name} job {job['_id']} (attempt {job['attempts']}): lease was lost")
+        elif update['status'] == 'failed':
+            self.failed(job, update['error'])
+        with self._changed:
+            self._changed.notify_all()
 
+    def failed(self, job, error):
+        """Run the on_failure hook for a job that will not be retried"""
+        if self.on_failure is None:
+            return
         try:
-            print("Parsing OpenAI response...")
-            questions = json.loads(response.choices[0].message.content)
-            print(f"Successfully parsed questions: {json.dumps(questions, indent=2)}")
-        except json.JSONDecodeError as e:
-            print(f"Error parsing OpenAI response: {str(e)}")
-            print(f"Raw response content: {response.choices[0].message.content}")
-            raise
-        
-        # Cache the results
-        cache_data = {
-            'cache_key': cache_key,
-            'questions': questions['questions'],
-            'created_at': datetime.now(pytz.timezone('Asia/Kolkata')).strftime('%Y-%m-%d %H:%M:%S')
-        }
-        papers_collection.insert_one(cache_data)
-        print("Cached the generated questions")
-        
+            self.on_failure(job, error)
+        except Exception as e:
+            print(f"Error in {self.name} on_failure for job {job['_id']}: {e}")
+
+    def worker_loop(self, worker_name):
+        while True:
+            self._wakeup.clear()
+            try:
+                job = self.claim(worker_name)
+            except Exception as e:
+                print(f"Error claiming {self.name} job: {e}")
+                job = None
+            if job:
+                self.run_job(job)
+                continue
+            self._wakeup.wait(self.poll_seconds)
+
+def run_pdf_job(job):
+    """Render and upload the PDF for job['paper_id']"""
+    paper = papers_collection.find_one(
+        {'_id': ObjectId(job['paper_id'])},
+        {'questions': 1, 'subjectName': 1, 'classGrade': 1, 'theme': 1}
+    )
+    if not paper:
+        raise ValueError(f"Paper {job['paper_id']} not found")
+    pdf_key = upload_paper_pdf(
+        job['paper_id'],
+        paper['questions'],
+        paper.get('subjectName'),
+        paper.get('classGrade'),
+        paper.get('theme') or DEFAULT_THEME
+    )
+    papers_collection.update_one({'_id': paper['_id']}, {'$set': {'pdf_key': pdf_key}})
+    return {'pdf_key': pdf_key}
+
+pdf_jobs = JobQueue(
+    pdf_jobs_collection,
+    run_pdf_job,
+    name='pdf',
+    workers=int(os.getenv('PDF_WORKERS', 2)),
+    max_attempts=int(os.getenv('PDF_JOB_MAX_ATTEMPTS', 3)),
+    lease_seconds=int(os.getenv('PDF_JOB_LEASE_SECONDS', 300)),
+    poll_seconds=float(os.getenv('PDF_JOB_POLL_SECONDS', 5)),
+    retry_seconds=float(os.getenv('PDF_JOB_RETRY_SECONDS', 5))
+)
+PDF_JOB_WAIT_SECONDS = float(os.getenv('PDF_JOB_WAIT_SECONDS', 60))
+# Off by default: /api/generate-questions returns the questions right away.
+# Clients that need pdf_url in the response can pass ?wait_for_pdf=true, or
+# set this to make every request wait up to that many seconds.
+PDF_INLINE_WAIT_SECONDS = float(os.getenv('PDF_INLINE_WAIT_SECONDS', 0))
+
+async def generate_paper(data, limit=None):
+    """Validate, generate and store one paper; returns (response body, HTTP status).
+
+    Shared by /api/generate-questions and the bulk generate_papers.py CLI.
+    """
+    error = validate_generation_request(data)
+    if error:
+        print(error)
         return {
-            'topic': topic_data['sectionName'],
-            'questions': questions['questions'],
-            'cached': False
-        }
-    except Exception as e:
-        print(f"Error generating questions for topic {topic_data['sectionName']}: {str(e)}")
-        print("Full error details:", e.__dict__)
-        raise
+            'success': False,
+            'error': error
+        }, 400
+
+    # Save request to MongoDB
+    request_id, topics = save_generation_request(data)
+
+    # Generate questions for all topics in parallel
+    all_questions = await generate_topics_concurrently(topics, data.get('previous_paper_id'), limit)
+
+    failed_topics = [t['topic'] for t in all_questions if 'error' in t]
+    if len(failed_topics) == len(all_questions):
+        return {
+            'success': False,
+            'error': 'Question generation failed for all topics',
+            'questions': all_questions
+        }, 500
+    if failed_topics:
+        print(f"Question generation failed for topics: {failed_topics}")
+    else:
+        print(f"Successfully generated questions for all topics")
+
+    # Save generated questions to MongoDB
+    paper_id = save_paper(data, request_id, all_questions)
+
+    # Render and upload the PDF in the background; poll /api/pdf-jobs/<id>
+    # (the route adds pdf_url if asked to wait and it finishes in time)
+    job_id = pdf_jobs.enqueue(paper_id=str(paper_id))
+
+    return {
+        'success': True,
+        'paper_id': str(paper_id),
+        'questions': all_questions,
+        'failed_topics': failed_topics,
+        'pdf_job_id': str(job_id),
+        'pdf_status': 'queued'
+    }, 200
 
 @app.route('/api/generate-questions', methods=['POST'])
-def generate_questions():
+async def generate_questions():
     try:
         print("Received request at /api/generate-questions")
         data = request.json
         print("Request data:", json.dumps(data, indent=2))
 
-        # Validate required fields
-        required_fields = ['subjectName', 'classGrade', 'topics']
-        for field in required_fields:
-            if field not in data:
-                print(f"Missing required field: {field}")
-                return jsonify({
-                    'success': False,
-                    'error': f"Missing required field: {field}"
-                }), 400
-
-        # Validate topic fields
-        required_topic_fields = ['sectionName', 'questionType', 'difficulty', 'bloomLevel', 'intelligenceType', 'numQuestions']
-        for i, topic in enumerate(data['topics']):
-            for field in required_topic_fields:
-                if not topic.get(field):
-                    print(f"Missing or empty required field '{field}' in topic {i+1}")
-                    return jsonify({
-                        'success': False,
-                        'error': f"Missing or empty required field '{field}' in topic {i+1}"
-                    }), 400
-
-        # Save request to MongoDB
-        data['created_at'] = datetime.now(pytz.timezone('Asia/Kolkata')).strftime('%Y-%m-%d %H:%M:%S')
-        request_id = requests_collection.insert_one(data).inserted_id
-        print(f"Saved request to MongoDB with ID: {request_id}")
-
-        # Generate questions for all topics
-        all_questions = []
-        for topic in data['topics']:
-            topic_data = {
-                **topic,
-                'subjectName': data['subjectName'],
-                'classGrade': data['classGrade']
-            }
-            questions = generate_questions_for_topic(topic_data, data.get('previous_paper_id'))
-            all_questions.append(questions)
-        
-        print(f"Successfully generated questions for all topics")
+        body, status = await generate_paper(data)
+        wait_seconds = PDF_INLINE_WAIT_SECONDS
+        if request.args.get('wait_for_pdf', '').lower() in ('1', 'true'):
+            wait_seconds = PDF_JOB_WAIT_SECONDS
+        if body.get('pdf_job_id') and wait_seconds > 0:
+            job = await asyncio.to_thread(pdf_jobs.wait, body['pdf_job_id'], wait_seconds)
+            if job:
+                body['pdf_status'] = job['status']
+                body['pdf_url'] = paper_pdf_url(job['pdf_key']) if job['status'] == 'done' else None
+                body['pdf_error'] = job.get('error')
+        return jsonify(body), status
 
-        # Save generated questions to MongoDB
-        paper_data = {
-            'request_id': str(request_id),
-            'questions': all_questions,
-            'created_at': datetime.now(pytz.timezone('Asia/Kolkata')).strftime('%Y-%m-%d %H:%M:%S'),
-            'previous_paper_id': data.get('previous_paper_id')
-        }
-        paper_id = papers_collection.insert_one(paper_data).inserted_id
-        print(f"Saved generated questions to MongoDB with ID: {paper_id}")
+    except Exception as e:
+        print("Error in /api/generate-questions:", str(e))
+        print("Full error details:", e.__dict__)
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+def format_stream_event(event, use_sse):
+    """Serialize one stream event as an SSE frame or an NDJSON line"""
+    payload = json.dumps(event, default=str)
+    if use_sse:
+        return f"event: {event['event']}\ndata: {payload}\n\n"
+    return payload + "\n"
 
-        # Generate PDF and upload to S3
+@app.route('/api/generate-questions/stream', methods=['POST'])
+def generate_questions_stream():
+    """Streaming variant of /api/generate-questions.
+
+    Emits a ``question`` event for each question as it streams in from
+    OpenAI and a ``topic`` event per topic as soon as it is generated
+    (completion order, with its input ``index``), then a final ``paper``
+    event with ``paper_id`` and, once the PDF job finishes (or after
+    PDF_JOB_WAIT_SECONDS), ``pdf_status`` and ``pdf_url``; or an ``error``
+    event. Responds with newline-delimited JSON, or server-sent events for
+    ``?format=sse`` / ``Accept: text/event-stream``.
+    """
+    print("Received request at /api/generate-questions/stream")
+    data = request.json
+    error = validate_generation_request(data)
+    if error:
+        print(error)
+        return jsonify({
+            'success': False,
+            'error': error
+        }), 400
+
+    use_sse = (
+        request.args.get('format') == 'sse'
+        or request.accept_mimetypes.best == 'text/event-stream'
+    )
+
+    def events():
         try:
-            pdf_filename = f"question_paper_{paper_id}.pdf"
-            pdf_buffer = create_pdf(all_questions, pdf_filename, data['subjectName'], data['classGrade'])
-            print("Successfully generated PDF")
-
-            # Upload to S3
-            s3_client.upload_fileobj(
-                pdf_buffer,
-                S3_BUCKET,
-                pdf_filename,
-                ExtraArgs={'ContentType': 'application/pdf'}
-            )
-            print(f"Successfully uploaded PDF to S3: {pdf_filename}")
-            
-            # Generate pre-signed URL with longer expiration
-            url = s3_client.generate_presigned_url(
-                'get_object',
-                Params={
-                    'Bucket': S3_BUCKET,
-                    'Key': pdf_filename
-                },
-                ExpiresIn=3600  # URL expires in 1 hour
-            )
-            print(f"Generated pre-signed URL for PDF: {url}")
+            request_id, topics = save_generation_request(data)
+            all_questions = [None] * len(topics)
+            for kind, index, payload in iter_topic_events(topics, data.get('previous_paper_id')):
+                if kind == 'question':
+                    yield format_stream_event({'event': 'question', 'index': index, 'question': payload}, use_sse)
+                else:
+                    all_questions[index] = payload
+                    yield format_stream_event({'event': 'topic', 'index': index, **payload}, use_sse)
 
-            return jsonify({
-                'success': True,
-                'paper_id': str(paper_id),
-                'questions': all_questions,
-                'pdf_url': url
-            })
+            failed_topics = [t['topic'] for t in all_questions if 'error' in t]
+            if len(failed_topics) == len(all_questions):
+                yield format_stream_event({
+                    'event': 'error',
+                    'error': 'Question generation failed for all topics'
+                }, use_sse)
+                return
+
+            paper_id = save_paper(data, request_id, all_questions)
+            job_id = pdf_jobs.enqueue(paper_id=str(paper_id))
+            job = pdf_jobs.wait(job_id, PDF_JOB_WAIT_SECONDS)
 
+            yield format_stream_event({
+                'event': 'paper',
+                'paper_id': str(paper_id),
+                'failed_topics': failed_topics,
+                'pdf_job_id': str(job_id),
+                'pdf_status': job['status'],
+                'pdf_url': paper_pdf_url(job['pdf_key']) if job['status'] == 'done' else None,
+                'pdf_error': job.get('error')
+            }, use_sse)
         except Exception as e:
-            print(f"Error with PDF generation or S3 upload: {e}")
+            print("Error in /api/generate-questions/stream:", str(e))
+            yield format_stream_event({'event': 'error', 'error': str(e)}, use_sse)
+
+    response = Response(
+        stream_with_context(events()),
+        mimetype='text/event-stream' if use_sse else 'application/x-ndjson'
+    )
+    # Keep proxies (nginx) from buffering the stream
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/api/pdf-jobs/<job_id>', methods=['GET'])
+def get_pdf_job(job_id):
+    if not ObjectId.is_valid(job_id):
+        return jsonify({
+            'success': False,
+            'error': 'Invalid job id'
+        }), 400
+    try:
+        pdf_jobs.start()
+        job = pdf_jobs.get(job_id)
+        if not job:
             return jsonify({
                 'success': False,
-                'error': f"Error generating PDF: {str(e)}"
-            }), 500
+                'error': 'Job not found'
+            }), 404
 
+        return jsonify({
+            'success': True,
+            'job_id': str(job['_id']),
+            'paper_id': job['paper_id'],
+            'status': job['status'],
+            'attempts': job['attempts'],
+            'error': job.get('error'),
+            'pdf_url': paper_pdf_url(job['pdf_key']) if job['status'] == 'done' else None
+        })
     except Exception as e:
-        print("Error in /api/generate-questions:", str(e))
-        print("Full error details:", e.__dict__)
         return jsonify({
             'success': False,
             'error': str(e)
         }), 500
 
+@app.route('/api/papers/export', methods=['POST'])
+def export_papers():
+    """Render several stored papers on the render farm and return one ZIP download"""
+    data = request.json or {}
+    paper_ids = data.get('paper_ids') or []
+    if not paper_ids or not all(ObjectId.is_valid(pid) for pid in paper_ids):
+        return jsonify({
+            'success': False,
+            'error': 'paper_ids must be a non-empty list of paper ids'
+        }), 400
+    if len(paper_ids) > PAPER_EXPORT_MAX:
+        return jsonify({
+            'success': False,
+            'error': f"At most {PAPER_EXPORT_MAX} papers can be exported at once"
+        }), 400
+
+    try:
+        papers = {
+            str(paper['_id']): paper
+            for paper in papers_collection.find(
+                {'_id': {'$in': [ObjectId(pid) for pid in paper_ids]}},
+                {'questions': 1, 'subjectName': 1, 'classGrade': 1, 'theme': 1}
+            )
+        }
+        missing = [pid for pid in paper_ids if pid not in papers]
+
+        try:
+            renders = {
+                pid: render_farm.submit(
+                    [t for t in paper['questions'] if 'error' not in t],
+                    paper.get('subjectName'),
+                    paper.get('classGrade'),
+                    paper.get('theme') or DEFAULT_THEME,
+                    timeout=PDF_RENDER_QUEUE_TIMEOUT
+                )
+                for pid, paper in papers.items()
+            }
+        except RenderQueueFull as e:
+            response = jsonify({
+                'success': False,
+                'error': str(e)
+            })
+            response.headers['Retry-After'] = '5'
+            return response, 503
+
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for pid, future in renders.items():
+                zf.writestr(f"question_paper_{pid}.pdf", future.result())
+        archive.seek(0)
+
+        export_key = f"exports/papers_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{ObjectId()}.zip"
+        s3_client.upload_fileobj(
+            archive,
+            S3_BUCKET,
+            export_key,
+            ExtraArgs={'ContentType': 'application/zip'}
+        )
+        return jsonify({
+            'success': True,
+            'exported': list(renders),
+            'missing': missing,
+            'url': paper_pdf_url(export_key)
+        })
+    except Exception as e:
+        print("Error in /api/papers/export:", str(e))
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/api/render-stats', methods=['GET'])
+def get_render_stats():
+    return jsonify({
+        'success': True,
+        'render_farm': render_farm.stats()
+    })
+
+@app.route('/api/openai-stats', methods=['GET'])
+def get_openai_stats():
+    return jsonify({
+        'success': True,
+        'openai': openai_api.stats(),
+        'pool': openai_pool.stats()
+    })
+
 @app.route('/api/download-pdf/<paper_id>', methods=['GET'])
 def download_pdf(paper_id):
     try:
+        # Papers point at a content-addressed key; older ones used the paper id
         filename = f"question_paper_{paper_id}.pdf"
-        # Generate a pre-signed URL for the S3 object
-        url = s3_client.generate_presigned_url(
-            'get_object',
-            Params={
-                'Bucket': S3_BUCKET,
-                'Key': filename
-            },
-            ExpiresIn=3600  # URL expires in 1 hour
-        )
+        if ObjectId.is_valid(paper_id):
+            paper = papers_collection.find_one({'_id': ObjectId(paper_id)}, {'pdf_key': 1})
+            if paper and paper.get('pdf_key'):
+                filename = paper['pdf_key']
+        # Pre-signed URL for the S3 object, reused until close to expiry
+        url = paper_pdf_url(filename)
         return jsonify({
             'success': True,
             'url': url
@@ -500,13 +2466,93 @@ def download_pdf(paper_id):
             'error': str(e)
         }), 500
 
+PAGE_SIZE_DEFAULT = 50
+PAGE_SIZE_MAX = 200
+
+def encode_cursor(last_id):
+    """Opaque continuation token pointing after the given _id"""
+    return base64.urlsafe_b64encode(json.dumps({'after': str(last_id)}).encode()).decode()
+
+def decode_cursor(token):
+    try:
+        return ObjectId(json.loads(base64.urlsafe_b64decode(token.encode()))['after'])
+    except Exception:
+        raise ValueError('Invalid cursor')
+
+def ist_date_to_object_id(value, days=0):
+    """ObjectId bound for the start of an IST calendar date (YYYY-MM-DD)"""
+    try:
+        day = datetime.strptime(value, '%Y-%m-%d') + timedelta(days=days)
+    except ValueError:
+        raise ValueError(f"Invalid date '{value}', expected YYYY-MM-DD")
+    return ObjectId.from_datetime(pytz.timezone('Asia/Kolkata').localize(day))
+
+def build_listing_query(args, base_query=None):
+    """Build a Mongo filter from listing query params.
+
+    Supports ``subject``, ``class``, ``from`` and ``to`` (inclusive IST dates)
+    and ``cursor``. Dates and the cursor become bounds on ``_id``, so every
+    page is an index range scan in ``_id`` order.
+    """
+    query = dict(base_query or {})
+    if args.get('subject'):
+        query['subjectName'] = args['subject']
+    if args.get('class'):
+        query['classGrade'] = args['class']
+
+    id_range = {}
+    if args.get('from'):
+        id_range['$gte'] = ist_date_to_object_id(args['from'])
+    upper_bounds = []
+    if args.get('to'):
+        upper_bounds.append(ist_date_to_object_id(args['to'], days=1))
+    if args.get('cursor'):
+        upper_bounds.append(decode_cursor(args['cursor']))
+    if upper_bounds:
+        id_range['$lt'] = min(upper_bounds)
+    if id_range:
+        query['_id'] = id_range
+    return query
+
+def parse_page_size(args):
+    try:
+        limit = int(args.get('limit', PAGE_SIZE_DEFAULT))
+    except ValueError:
+        raise ValueError('limit must be an integer')
+    return max(1, min(limit, PAGE_SIZE_MAX))
+
+def fetch_page(collection, query, projection, limit):
+    """Fetch one newest-first page; returns (docs, next_cursor)"""
+    docs = list(collection.find(query, projection).sort('_id', DESCENDING).limit(limit + 1))
+    next_cursor = encode_cursor(docs[limit - 1]['_id']) if len(docs) > limit else None
+    docs = docs[:limit]
+    for doc in docs:
+        doc['_id'] = str(doc['_id'])
+    return docs, next_cursor
+
 @app.route('/api/requests', methods=['GET'])
 def get_requests():
     try:
-        requests = list(requests_collection.find({}, {'_id': 1, 'created_at': 1, 'subjectName': 1, 'classGrade': 1}))
-        for req in requests:
-            req['_id'] = str(req['_id'])
-        return jsonify(requests)
+        query = build_listing_query(request.args)
+        limit = parse_page_size(request.args)
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+
+    try:
+        requests, next_cursor = fetch_page(
+            requests_collection,
+            query,
+            {'_id': 1, 'created_at': 1, 'subjectName': 1, 'classGrade': 1},
+            limit
+        )
+        return jsonify({
+            'success': True,
+            'requests': requests,
+            'next_cursor': next_cursor
+        })
     except Exception as e:
         return jsonify({
             'success': False,
@@ -516,16 +2562,43 @@ def get_requests():
 @app.route('/api/papers', methods=['GET'])
 def get_papers():
     try:
-        papers = list(papers_collection.find({}, {'_id': 1, 'created_at': 1, 'request_id': 1}))
-        for paper in papers:
-            paper['_id'] = str(paper['_id'])
-        return jsonify(papers)
+        # Skip cache rows written here before the question_cache collection existed
+        query = build_listing_query(request.args, {'cache_key': {'$exists': False}})
+        limit = parse_page_size(request.args)
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+
+    try:
+        papers, next_cursor = fetch_page(
+            papers_collection,
+            query,
+            {'_id': 1, 'created_at': 1, 'request_id': 1, 'subjectName': 1, 'classGrade': 1},
+            limit
+        )
+        return jsonify({
+            'success': True,
+            'papers': papers,
+            'next_cursor': next_cursor
+        })
     except Exception as e:
         return jsonify({
             'success': False,
             'error': str(e)
         }), 500
 
+@app.route('/api/cache-stats', methods=['GET'])
+def get_cache_stats():
+    return jsonify({
+        'success': True,
+        'topic_cache': topic_cache.stats(),
+        'topic_flights': topic_flights.stats(),
+        'presigned_url_cache': presigned_url_cache.stats(),
+        'similar_topics': similar_topics.stats()
+    })
+
 @app.route('/api/submit-feedback', methods=['POST'])
 def submit_feedback():
     try:
@@ -577,6 +2650,402 @@ def get_feedback(paper_id):
             'error': str(e)
         }), 500
 
+class NoteUploadError(ValueError):
+    """A note upload was rejected: too large, not a PDF or a checksum mismatch"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def content_md5(data):
+    return base64.b64encode(hashlib.md5(data).digest()).decode()
+
+def stream_to_s3(stream, bucket, key, content_type='application/pdf', max_bytes=None, expected_sha256=None):
+    """Stream a file object to S3 in multipart chunks with bounded memory.
+
+    Reads NOTE_UPLOAD_PART_SIZE bytes at a time and uploads up to
+    NOTE_UPLOAD_CONCURRENCY parts in parallel, each with a Content-MD5 that
+    S3 verifies. Enforces ``max_bytes`` and, if given, the SHA-256 of the
+    whole body before the object is committed. Returns ``(size, sha256)``;
+    on any failure the multipart upload is aborted, leaving no partial object.
+    """
+    max_bytes = max_bytes or NOTE_UPLOAD_MAX_BYTES
+    digest = hashlib.sha256()
+    size = 0
+
+    def read_part():
+        nonlocal size
+        chunks = []
+        remaining = NOTE_UPLOAD_PART_SIZE
+        while remaining > 0:
+            chunk = stream.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+            size += len(chunk)
+            if size > max_bytes:
+                raise NoteUploadError(f"File exceeds the {max_bytes // (1024 * 1024)} MB limit", 413)
+        data = b''.join(chunks)
+        digest.update(data)
+        return data
+
+    def check_checksum():
+        if expected_sha256 and digest.hexdigest() != expected_sha256.strip().lower():
+            raise NoteUploadError('Checksum mismatch: upload was corrupted in transit')
+
+    data = read_part()
+    if not data.startswith(b'%PDF-'):
+        raise NoteUploadError('Only PDF files are allowed')
+
+    if len(data) < NOTE_UPLOAD_PART_SIZE:
+        # Fits in one part: a single PUT is cheaper than a multipart upload
+        check_checksum()
+        s3_client.put_object(
+            Bucket=bucket,
+            Key=key,
+            Body=data,
+            ContentType=content_type,
+            ContentMD5=content_md5(data)
+        )
+        return size, digest.hexdigest()
+
+    upload_id = s3_client.create_multipart_upload(
+        Bucket=bucket,
+        Key=key,
+        ContentType=content_type
+    )['UploadId']
+
+    def upload_part(part_number, body):
+        response = s3_client.upload_part(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=body,
+            ContentMD5=content_md5(body)
+        )
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+    # Bounds buffered parts to NOTE_UPLOAD_CONCURRENCY + the one being read
+    slots = threading.BoundedSemaphore(NOTE_UPLOAD_CONCURRENCY)
+    futures = []
+    try:
+        part_number = 1
+        while data:
+            slots.acquire()
+            future = note_upload_executor.submit(upload_part, part_number, data)
+            future.add_done_callback(lambda _: slots.release())
+            futures.append(future)
+            failed = next((f for f in futures if f.done() and f.exception()), None)
+            if failed:
+                raise failed.exception()
+            part_number += 1
+            data = read_part()
+
+        parts = [future.result() for future in futures]
+        check_checksum()
+        s3_client.complete_multipart_upload(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': parts}
+        )
+        return size, digest.hexdigest()
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        wait(futures)
+        s3_client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+
+def save_note(filename, original_name, size, sha256):
+    """Store note metadata and queue text extraction; returns (note_id, pre-signed download URL)"""
+    url = presigned_url(NOTES_BUCKET, filename)
+    note_data = {
+        'filename': filename,
+        'original_name': original_name,
+        'uploaded_at': datetime.now(pytz.timezone('Asia/Kolkata')).strftime('%Y-%m-%d %H:%M:%S'),
+        's3_url': url,
+        'size': size,
+        'sha256': sha256,
+        'text_status': 'pending'
+    }
+    note_id = db['notes'].insert_one(note_data).inserted_id
+    note_text_jobs.enqueue(note_id=str(note_id))
+    return note_id, url
+
+def note_key(original_name):
+    return f"notes/{datetime.now().strftime('%Y%m%d_%H%M%S')}_{secure_filename(original_name)}"
+
+# Uploaded notes are split into chunks of about this many characters
+NOTE_CHUNK_CHARS = int(os.getenv('NOTE_CHUNK_CHARS', 2000))
+
+def normalize_note_text(text):
+    """Clean up PDF-extracted text: rejoin hyphenated line breaks, collapse whitespace"""
+    text = (text or '').replace('\x00', '').replace('\r\n', '\n').replace('\r', '\n')
+    text = re.sub(r'(\w)-\n(\w)', r'\1\2', text)
+    text = re.sub(r'[ \t\f\v]+', ' ', text)
+    text = re.sub(r' *\n *', '\n', text)
+    text = re.sub(r'\n{3,}', '\n\n', text)
+    return text.strip()
+
+def estimate_tokens(text):
+    """Rough token count (about 4 characters per token for English text)"""
+    return (len(text) + 3) // 4
+
+def iter_pdf_pages(pdf_file, start_page=1, end_page=None, max_tokens=None, normalize=True):
+    """Lazily yield ``(page_number, text)`` for a PDF, one page at a time.
+
+    ``pdf_file`` is a file object or an open PyPDF2.PdfReader. Pages are
+    1-based and ``end_page`` is inclusive. With ``max_tokens``, extraction
+    stops once the pages yielded so far reach that many tokens; closing the
+    generator stops it at any point. Only one page's text is held at a time.
+    """
+    import PyPDF2
+
+    reader = pdf_file if isinstance(pdf_file, PyPDF2.PdfReader) else PyPDF2.PdfReader(pdf_file)
+    last_page = len(reader.pages) if end_page is None else min(end_page, len(reader.pages))
+    used_tokens = 0
+    for page_number in range(max(start_page, 1), last_page + 1):
+        text = reader.pages[page_number - 1].extract_text() or ''
+        if normalize:
+            text = normalize_note_text(text)
+        yield page_number, text
+        if max_tokens is not None:
+            used_tokens += count_tokens(text)
+            if used_tokens >= max_tokens:
+                return
+
+def split_for_chunks(text, max_chars):
+    """Split text into pieces of at most max_chars, preferring paragraph and sentence breaks"""
+    if len(text) <= max_chars:
+        return [text] if text else []
+    pieces = []
+    for paragraph in text.split('\n\n'):
+        if len(paragraph) <= max_chars:
+            pieces.append(paragraph)
+            continue
+        for sentence in re.split(r'(?<=[.!?])\s+', paragraph):
+            while len(sentence) > max_chars:
+                pieces.append(sentence[:max_chars])
+                sentence = sentence[max_chars:]
+            if sentence:
+                pieces.append(sentence)
+    return pieces
+
+def chunk_pages(pages, max_chars=None):
+    """Pack ``(page_number, text)`` pairs into chunks with page and character offsets.
+
+    Character offsets index into the text of all chunks joined by blank lines,
+    which is what get_note_text() returns.
+    """
+    max_chars = max_chars or NOTE_CHUNK_CHARS
+    chunk = None
+    offset = 0
+    index = 0
+    for page_number, page_text in pages:
+        for piece in split_for_chunks(page_text, max_chars):
+            if chunk and len(chunk['text']) + 2 + len(piece) > max_chars:
+                yield chunk
+                index += 1
+                chunk = None
+            if chunk is None:
+                chunk = {
+                    'index': index,
+                    'page_start': page_number,
+                    'page_end': page_number,
+                    'char_start': offset,
+                    'text': piece
+                }
+            else:
+                chunk['text'] += '\n\n' + piece
+                chunk['page_end'] = page_number
+            offset += len(piece) + 2
+            chunk['char_end'] = offset - 2
+    if chunk:
+        yield chunk
+
+def run_note_text_job(job):
+    """Download a note from S3, extract its text page by page and store the chunks"""
+    import PyPDF2
+
+    note_id = ObjectId(job['note_id'])
+    note = db['notes'].find_one({'_id': note_id}, {'filename': 1})
+    if not note:
+        raise ValueError(f"Note {job['note_id']} not found")
+
+    with tempfile.TemporaryFile() as pdf_file:
+        s3_client.download_fileobj(NOTES_BUCKET, note['filename'], pdf_file)
+        pdf_file.seek(0)
+        reader = PyPDF2.PdfReader(pdf_file)
+        pages = iter_pdf_pages(reader)
+
+        # Replace any chunks from an earlier, interrupted attempt
+        note_chunks_collection.delete_many({'note_id': note_id})
+        batch = []
+        chunk_count = 0
+        preview = ''
+        for chunk in chunk_pages(pages):
+            if not preview:
+                preview = chunk['text'][:500]
+            batch.append({'note_id': note_id, **chunk})
+            chunk_count += 1
+            if len(batch) >= 100:
+                note_chunks_collection.insert_many(batch)
+                batch = []
+        if batch:
+            note_chunks_collection.insert_many(batch)
+        page_count = len(reader.pages)
+
+    db['notes'].update_one({'_id': note_id}, {'$set': {
+        'text_status': 'ready',
+        'page_count': page_count,
+        'chunk_count': chunk_count,
+        'text_preview': preview
+    }})
+    note_search_indexes.discard(job['note_id'])
+    print(f"Extracted {chunk_count} chunks from {page_count} pages of note {job['note_id']}")
+    return {'chunk_count': chunk_count}
+
+def mark_note_text_failed(job, error):
+    """Record that a note's text could not be extracted, so it is not waited on forever"""
+    db['notes'].update_one(
+        {'_id': ObjectId(job['note_id'])},
+        {'$set': {'text_status': 'failed', 'text_error': error}}
+    )
+
+def note_text_status(note_id):
+    """'pending', 'ready' or 'failed'; None for an unknown note"""
+    try:
+        note = db['notes'].find_one({'_id': ObjectId(note_id)}, {'text_status': 1})
+    except Exception:
+        return None
+    if not note:
+        return None
+    return note.get('text_status', 'pending')
+
+def note_text_ready(note_id):
+    return note_text_status(note_id) == 'ready'
+
+def get_note_text(note_id):
+    """Precomputed note text from its chunks ('' until extraction has finished)"""
+    chunks = note_chunks_collection.find(
+        {'note_id': ObjectId(note_id)},
+        {'_id': 0, 'text': 1}
+    ).sort('index', ASCENDING)
+    return '\n\n'.join(chunk['text'] for chunk in chunks)
+
+# Token budget for note context in a prompt; the most relevant chunks are picked
+NOTE_CONTEXT_TOKENS = int(os.getenv('NOTE_CONTEXT_TOKENS', 1500))
+
+SEARCH_STOPWORDS = frozenset("""
+a an and are as at be by for from has have in is it its of on or that the this
+to was were will with what which who how why when where do does not no can
+""".split())
+
+def search_terms(text):
+    """Lower-cased word tokens for relevance ranking, without stopwords"""
+    return [
+        term for term in re.findall(r'[a-z0-9]+', (text or '').lower())
+        if len(term) > 1 and term not in SEARCH_STOPWORDS
+    ]
+
+class BM25Index:
+    """Okapi BM25 ranking over a fixed list of documents"""
+
+    def __init__(self, documents, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.term_counts = [Counter(search_terms(doc)) for doc in documents]
+        self.lengths = [sum(counts.values()) for counts in self.term_counts]
+        self.average_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0
+        document_frequency = Counter()
+        for counts in self.term_counts:
+            document_frequency.update(counts.keys())
+        total = len(documents)
+        self.idf = {
+            term: math.log(1 + (total - freq + 0.5) / (freq + 0.5))
+            for term, freq in document_frequency.items()
+        }
+
+    def scores(self, query):
+        terms = [term for term in set(search_terms(query)) if term in self.idf]
+        results = []
+        for counts, length in zip(self.term_counts, self.lengths):
+            norm = self.k1 * (1 - self.b + self.b * length / (self.average_length or 1))
+            score = 0.0
+            for term in terms:
+                freq = counts.get(term)
+                if freq:
+                    score += self.idf[term] * freq * (self.k1 + 1) / (freq + norm)
+            results.append(score)
+        return results
+
+# Per-note BM25 indexes, built on first use from the stored chunks
+note_search_indexes = TTLCache(
+    max_size=int(os.getenv('NOTE_INDEX_CACHE_SIZE', 64)),
+    ttl=int(os.getenv('NOTE_INDEX_CACHE_TTL', 3600))
+)
+
+def get_note_search_index(note_id):
+    """(chunks, BM25Index) for a note whose text has been extracted"""
+    entry = note_search_indexes.get(note_id)
+    if entry is None:
+        chunks = list(note_chunks_collection.find(
+            {'note_id': ObjectId(note_id)},
+            {'_id': 0, 'index': 1, 'page_start': 1, 'page_end': 1, 'text': 1}
+        ).sort('index', ASCENDING))
+        entry = (chunks, BM25Index([chunk['text'] for chunk in chunks]))
+        if chunks and note_text_ready(note_id):
+            note_search_indexes.set(note_id, entry)
+    return entry
+
+def select_note_context(note_id, query, max_tokens=None):
+    """The note chunks most relevant to ``query`` that fit in ``max_tokens``.
+
+    Chunks are picked by BM25 score (document order when nothing matches)
+    and returned in document order, labelled with their pages.
+    """
+    max_tokens = NOTE_CONTEXT_TOKENS if max_tokens is None else max_tokens
+    chunks, index = get_note_search_index(note_id)
+    if not chunks or max_tokens <= 0:
+        return ''
+
+    def label(chunk):
+        if chunk['page_start'] == chunk['page_end']:
+            return f"[p. {chunk['page_start']}]"
+        return f"[pp. {chunk['page_start']}-{chunk['page_end']}]"
+
+    scores = index.scores(query)
+    ranked = sorted(range(len(chunks)), key=lambda i: (-scores[i], i))
+    selected = {}
+    used_tokens = 0
+    for i in ranked:
+        text = f"{label(chunks[i])} {chunks[i]['text']}"
+        tokens = count_tokens(text) + 1
+        if used_tokens + tokens <= max_tokens:
+            selected[i] = text
+            used_tokens += tokens
+    if not selected:
+        # Even the best chunk is over budget; use as much of it as fits
+        best = ranked[0]
+        return trim_to_tokens(f"{label(chunks[best])} {chunks[best]['text']}", max_tokens)
+
+    return '\n\n'.join(selected[i] for i in sorted(selected))
+
+note_text_jobs = JobQueue(
+    note_jobs_collection,
+    run_note_text_job,
+    name='note-text',
+    workers=int(os.getenv('NOTE_TEXT_WORKERS', 1)),
+    max_attempts=int(os.getenv('NOTE_TEXT_MAX_ATTEMPTS', 3)),
+    lease_seconds=int(os.getenv('NOTE_TEXT_LEASE_SECONDS', 900)),
+    poll_seconds=float(os.getenv('PDF_JOB_POLL_SECONDS', 5)),
+    retry_seconds=float(os.getenv('NOTE_TEXT_RETRY_SECONDS', 5)),
+    on_failure=mark_note_text_failed
+)
+
 @app.route('/api/upload-note', methods=['POST'])
 def upload_note():
     try:
@@ -599,38 +3068,17 @@ def upload_note():
                 'error': 'Only PDF files are allowed'
             }), 400
 
-        # Generate unique filename
-        filename = f"notes/{datetime.now().strftime('%Y%m%d_%H%M%S')}_{file.filename}"
-        
-        # Upload to S3
-        s3_client.upload_fileobj(
-            file,
+        # Stream to S3 in parts, verifying size and checksum on the way
+        filename = note_key(file.filename)
+        size, sha256 = stream_to_s3(
+            file.stream,
             NOTES_BUCKET,
             filename,
-            ExtraArgs={
-                'ContentType': 'application/pdf'
-            }
-        )
-
-        # Generate pre-signed URL for download
-        url = s3_client.generate_presigned_url(
-            'get_object',
-            Params={
-                'Bucket': NOTES_BUCKET,
-                'Key': filename
-            },
-            ExpiresIn=3600  # URL expires in 1 hour
+            expected_sha256=request.form.get('sha256') or request.headers.get('X-Content-SHA256')
         )
 
         # Save note metadata to MongoDB
-        note_data = {
-            'filename': filename,
-            'original_name': file.filename,
-            'uploaded_at': datetime.now(pytz.timezone('Asia/Kolkata')).strftime('%Y-%m-%d %H:%M:%S'),
-            's3_url': url
-        }
-        notes_collection = db['notes']
-        note_id = notes_collection.insert_one(note_data).inserted_id
+        note_id, url = save_note(filename, file.filename, size, sha256)
 
         return jsonify({
             'success': True,
@@ -639,6 +3087,58 @@ def upload_note():
             'url': url
         })
 
+    except NoteUploadError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), e.status
+    except RequestEntityTooLarge:
+        raise
+    except Exception as e:
+        print(f"Error uploading note: {e}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/api/upload-note/stream', methods=['POST'])
+def upload_note_stream():
+    """Upload a note as the raw request body (no multipart form parsing).
+
+    The PDF is piped from the socket to S3 part by part, so large scanned
+    books never sit in memory or on local disk. Pass the name as
+    ``?filename=`` and optionally the body's SHA-256 as ``X-Content-SHA256``.
+    """
+    original_name = request.args.get('filename', '')
+    if not original_name.lower().endswith('.pdf'):
+        return jsonify({
+            'success': False,
+            'error': 'Only PDF files are allowed'
+        }), 400
+
+    try:
+        filename = note_key(original_name)
+        size, sha256 = stream_to_s3(
+            request.stream,
+            NOTES_BUCKET,
+            filename,
+            expected_sha256=request.headers.get('X-Content-SHA256')
+        )
+        note_id, url = save_note(filename, original_name, size, sha256)
+
+        return jsonify({
+            'success': True,
+            'note_id': str(note_id),
+            'filename': original_name,
+            'url': url
+        })
+    except NoteUploadError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), e.status
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
         print(f"Error uploading note: {e}")
         return jsonify({
@@ -651,20 +3151,15 @@ def get_notes():
     try:
         notes = list(db['notes'].find(
             {},
-            {'_id': 1, 'original_name': 1, 'uploaded_at': 1, 'text_preview': 1}
+            {'_id': 1, 'filename': 1, 'original_name': 1, 'uploaded_at': 1, 'text_preview': 1,
+             'text_status': 1, 'text_error': 1}
         ).sort('uploaded_at', -1))
         
+        # Sign all keys in one pass; cached URLs are reused until near expiry
+        urls = presigned_urls(NOTES_BUCKET, [note['filename'] for note in notes])
         for note in notes:
             note['_id'] = str(note['_id'])
-            # Generate fresh pre-signed URL
-            note['url'] = s3_client.generate_presigned_url(
-                'get_object',
-                Params={
-                    'Bucket': NOTES_BUCKET,
-                    'Key': note['filename']
-                },
-                ExpiresIn=3600
-            )
+            note['url'] = urls[note['filename']]
         
         return jsonify({
             'success': True,
@@ -680,24 +3175,28 @@ def get_notes():
 def not_found(e):
     return jsonify({"error": "Resource not found"}), 404
 
+@app.errorhandler(413)
+def too_large(e):
+    return jsonify({"error": "Uploaded file is too large"}), 413
+
 @app.errorhandler(500)
 def server_error(e):
     return jsonify({"error": "Internal server error"}), 500
 
-def extract_text_from_pdf(pdf_file):
-    """Extract text content from PDF file"""
+def extract_text_from_pdf(pdf_file, start_page=1, end_page=None, max_tokens=None):
+    """Extract text content from PDF file (see iter_pdf_pages() for the arguments)"""
     try:
-        import PyPDF2
-        pdf_reader = PyPDF2.PdfReader(pdf_file)
-        text = ""
-        for page in pdf_reader.pages:
-            text += page.extract_text()
-        return text
+        return "".join(
+            text for _, text in iter_pdf_pages(pdf_file, start_page, end_page, max_tokens, normalize=False)
+        )
     except Exception as e:
         print(f"Error extracting text from PDF: {e}")
         return None
 
 if __name__ == '__main__':
+    startup()
+    pdf_jobs.start()
+    note_text_jobs.start()
     port = int(os.environ.get('PORT', 5000))
     print(f"🚀 Server starting on http://localhost:{port}")
     print(f"📁 Serving static files from: {os.path.abspath(app.static_folder)}")
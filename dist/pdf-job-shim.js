@@ -0,0 +1,39 @@
+// Stopgap for the prebuilt bundle in this directory. It predates background
+// PDF jobs and reads pdf_url straight from the /api/generate-questions
+// response. This waits for the PDF job and fills pdf_url in, as src/App.tsx
+// does. `npm run build` rebuilds dist/ and drops this file.
+(function () {
+  var originalFetch = window.fetch.bind(window);
+
+  function sleep(ms) {
+    return new Promise(function (resolve) { setTimeout(resolve, ms); });
+  }
+
+  async function waitForPdf(jobId) {
+    for (var attempt = 0; attempt < 120; attempt++) {
+      var job = await (await originalFetch('/api/pdf-jobs/' + jobId)).json();
+      if (job.success && job.status === 'done' && job.pdf_url) {
+        return job.pdf_url;
+      }
+      if (!job.success || job.status === 'failed') {
+        throw new Error(job.error || 'Failed to generate PDF');
+      }
+      await sleep(1000);
+    }
+    throw new Error('Timed out waiting for PDF');
+  }
+
+  window.fetch = async function (input, init) {
+    var response = await originalFetch(input, init);
+    var url = new URL(typeof input === 'string' ? input : input.url, window.location.href);
+    if (!response.ok || url.pathname !== '/api/generate-questions') {
+      return response;
+    }
+    var body = await response.clone().json();
+    if (!body.success || body.pdf_url || !body.pdf_job_id) {
+      return response;
+    }
+    body.pdf_url = await waitForPdf(body.pdf_job_id);
+    return new Response(JSON.stringify(body), { status: response.status, headers: response.headers });
+  };
+})();
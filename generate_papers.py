@@ -0,0 +1,413 @@
+"""
+Generate question papers in bulk from a file of paper specs.
+
+Each spec has the same shape as the /api/generate-questions request body and
+goes through the same pipeline (question cache, MongoDB, PDF job). PDF jobs
+are run by this process, and each paper waits until its PDF is done before
+the next spec starts on that worker; a paper whose PDF job fails counts as
+failed.
+
+Input formats:
+    .jsonl  one spec per line
+    .json   one spec or a list of specs (e.g. Samples/Sample.json)
+    .xlsx   one topic per row, with a header row. subjectName, classGrade,
+            language, theme and previous_paper_id are paper columns; every
+            other column is a topic field. Rows with the same value in a
+            "paper" column form one paper; without that column each row is
+            its own paper.
+
+Usage:
+    python generate_papers.py specs.jsonl results.jsonl
+    python generate_papers.py specs.xlsx results.xlsx --workers 8
+
+Finished papers are checkpointed to <output>.checkpoint.jsonl as they
+complete. Rerunning the same command skips them and retries only the specs
+that failed or never ran. The output is written in input order once every
+spec has been attempted.
+
+Offline mode (--offline) is for overnight runs: every uncached topic is sent
+as one OpenAI Batch API job (half the price of live calls, results within
+24 hours), and the results are written to the question cache. The normal
+pass then builds the papers from the cache; only topics the batch could not
+answer are generated live. The submitted batch is recorded in
+<output>.batch.json as each batch starts, so rerunning the command resumes
+polling (and submits only what an interrupted run had not) instead of
+submitting again. OPENAI_BASE_URL points the Batch API calls elsewhere,
+e.g. at a local fake for testing.
+
+    python generate_papers.py specs.jsonl results.jsonl --offline
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from app import (
+    PDF_JOB_WAIT_SECONDS, TOPIC_CONCURRENCY, QuestionDeduper, cache_topic_questions,
+    chat_completion_request, completion_token_budget, find_cached_questions,
+    generate_cache_key, generate_paper, generate_question_prompt, openai_client,
+    parse_completion_questions, pdf_jobs, split_topic_batches, startup, topic_cache,
+    validate_generation_request
+)
+
+# The Batch API accepts at most 50,000 requests per input file
+BATCH_MAX_REQUESTS = 50000
+BATCH_FINAL_STATES = ('completed', 'failed', 'expired', 'cancelled')
+PAPER_COLUMNS = ('subjectName', 'classGrade', 'language', 'theme', 'previous_paper_id')
+RESULT_COLUMNS = ('spec', 'success', 'subjectName', 'classGrade', 'paper_id',
+                  'question_count', 'failed_topics', 'pdf_job_id', 'pdf_status', 'pdf_key', 'error')
+
+def read_jsonl(path):
+    with open(path, encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError as e:
+                    yield {'_invalid': f"Line {line_number}: {e}"}
+
+def read_json(path):
+    with open(path, encoding='utf-8') as f:
+        text = f.read()
+    # Only the first JSON value is used; some sample files carry notes after it
+    value, end = json.JSONDecoder().raw_decode(text.lstrip())
+    if text.lstrip()[end:].strip():
+        print(f"Ignoring trailing content after the JSON value in {path}")
+    return value if isinstance(value, list) else [value]
+
+def read_xlsx(path):
+    try:
+        import openpyxl
+    except ImportError:
+        sys.exit("Reading .xlsx files needs openpyxl (pip install openpyxl)")
+
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    rows = workbook.active.iter_rows(values_only=True)
+    header = [str(cell).strip() if cell is not None else '' for cell in next(rows, [])]
+    specs = {}
+    for row_number, row in enumerate(rows, 2):
+        values = {
+            column: str(cell).strip()
+            for column, cell in zip(header, row)
+            if column and cell is not None and str(cell).strip()
+        }
+        if not values:
+            continue
+        paper = values.pop('paper', None) or f"row {row_number}"
+        spec = specs.setdefault(paper, {'topics': []})
+        for column in PAPER_COLUMNS:
+            if column in values:
+                spec.setdefault(column, values.pop(column))
+        spec['topics'].append(values)
+    workbook.close()
+    return list(specs.values())
+
+def read_specs(path):
+    extension = os.path.splitext(path)[1].lower()
+    readers = {'.jsonl': read_jsonl, '.json': read_json, '.xlsx': read_xlsx}
+    if extension not in readers:
+        sys.exit(f"Unsupported input format '{extension}'; use .jsonl, .json or .xlsx")
+    return readers[extension](path)
+
+def spec_key(spec):
+    """Identifies a spec across runs, so an edited input file is not skipped"""
+    return hashlib.sha256(json.dumps(spec, sort_keys=True, default=str).encode()).hexdigest()
+
+def load_checkpoint(path):
+    """Finished results from an earlier run, keyed by (spec index, spec key)"""
+    done = {}
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # a line cut short by an interrupted run
+                if entry['result'].get('pdf_job_id') and entry['result'].get('pdf_status') != 'done':
+                    continue  # written before its PDF finished; generate it again
+                done[(entry['spec'], entry['key'])] = entry['result']
+    return done
+
+def run_spec(index, spec, topic_limit):
+    """Generate one paper; never raises, so one bad spec cannot stop the batch"""
+    result = {'spec': index, 'subjectName': spec.get('subjectName'), 'classGrade': spec.get('classGrade')}
+    if '_invalid' in spec:
+        return {**result, 'success': False, 'error': spec['_invalid']}
+    try:
+        # generate_paper() stores the request, which adds _id to the dict
+        body, status = asyncio.run(generate_paper(dict(spec), topic_limit))
+    except Exception as e:
+        return {**result, 'success': False, 'error': str(e)}
+    questions = body.get('questions', [])
+    pdf_job = None
+    error = body.get('error')
+    if body.get('pdf_job_id'):
+        # The PDF job runs on this process's workers, which die with it, so wait
+        # until it is finished; the spec only counts (and is checkpointed) once
+        # its PDF is done
+        pdf_job = pdf_jobs.wait(body['pdf_job_id'], PDF_JOB_WAIT_SECONDS)
+        while pdf_job and pdf_job['status'] not in ('done', 'failed'):
+            print(f"Still waiting for PDF job {body['pdf_job_id']} ({pdf_job['status']})")
+            pdf_job = pdf_jobs.wait(body['pdf_job_id'], PDF_JOB_WAIT_SECONDS)
+        if not pdf_job or pdf_job['status'] != 'done':
+            error = f"PDF job failed: {pdf_job.get('error') if pdf_job else 'job not found'}"
+    return {
+        **result,
+        'success': body['success'] and error is None,
+        'paper_id': body.get('paper_id'),
+        'question_count': sum(len(topic['questions']) for topic in questions),
+        'failed_topics': body.get('failed_topics', [t['topic'] for t in questions if 'error' in t]),
+        'pdf_job_id': body.get('pdf_job_id'),
+        'pdf_status': pdf_job['status'] if pdf_job else None,
+        'pdf_key': pdf_job.get('pdf_key') if pdf_job else None,
+        'error': error,
+        'questions': questions
+    }
+
+def plan_batch_requests(specs):
+    """Batch API request lines for every distinct uncached topic in ``specs``.
+
+    Returns ``(requests, topics)``; ``topics`` maps a cache key to the topic
+    and the number of request parts (big topics are split as in live mode).
+    """
+    requests, topics = [], {}
+    for spec in specs:
+        if '_invalid' in spec or validate_generation_request(spec):
+            continue
+        for topic in spec['topics']:
+            topic_data = {**topic, 'subjectName': spec['subjectName'], 'classGrade': spec['classGrade']}
+            cache_key = generate_cache_key(topic_data)
+            if cache_key in topics or topic_cache.get(cache_key) is not None \
+                    or find_cached_questions(cache_key) is not None:
+                continue
+            batches = split_topic_batches(topic_data)
+            topics[cache_key] = {'topic': topic_data, 'parts': len(batches)}
+            for part, batch in enumerate(batches, 1):
+                max_tokens = completion_token_budget(batch)
+                prompt = generate_question_prompt(
+                    batch, spec.get('previous_paper_id'), batch.get('noteId'), max_tokens
+                )
+                requests.append({
+                    'custom_id': f"{cache_key}:{part}",
+                    'method': 'POST',
+                    'url': '/v1/chat/completions',
+                    'body': chat_completion_request(prompt, max_tokens)
+                })
+    return requests, topics
+
+def save_batch_state(state_path, state):
+    with open(state_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+
+def submit_batches(requests, state, state_path):
+    """Upload the requests as Batch API input files and start the batches.
+
+    Each started batch is added to ``state`` and saved before the next file
+    is uploaded, so a failure part way through never leaves a paid-for
+    batch unrecorded.
+    """
+    for start in range(0, len(requests), BATCH_MAX_REQUESTS):
+        lines = requests[start:start + BATCH_MAX_REQUESTS]
+        body = ''.join(json.dumps(line) + '\n' for line in lines).encode('utf-8')
+        input_file = openai_client.files.create(file=('questions.jsonl', body), purpose='batch')
+        batch = openai_client.batches.create(
+            input_file_id=input_file.id,
+            endpoint='/v1/chat/completions',
+            completion_window='24h'
+        )
+        print(f"Submitted batch {batch.id} with {len(lines)} requests")
+        state['batch_ids'].append(batch.id)
+        state['submitted'].extend(line['custom_id'] for line in lines)
+        save_batch_state(state_path, state)
+
+def wait_for_batch(batch_id, poll_seconds):
+    """Poll a batch until it reaches a final state; returns the batch"""
+    while True:
+        batch = openai_client.batches.retrieve(batch_id)
+        counts = batch.request_counts
+        progress = f" ({counts.completed}/{counts.total} done, {counts.failed} failed)" if counts else ""
+        print(f"Batch {batch_id}: {batch.status}{progress}")
+        if batch.status in BATCH_FINAL_STATES:
+            return batch
+        time.sleep(poll_seconds)
+
+def read_batch_output(batch, topics):
+    """Valid questions per custom_id from a finished batch's output file"""
+    results = {}
+    if not batch.output_file_id:
+        return results
+    for line in openai_client.files.content(batch.output_file_id).text.splitlines():
+        if not line.strip():
+            continue
+        entry = json.loads(line)
+        response = entry.get('response') or {}
+        if response.get('status_code') != 200:
+            print(f"Batch request {entry['custom_id']} failed: {entry.get('error') or response.get('body')}")
+            continue
+        try:
+            content = response['body']['choices'][0]['message']['content']
+            cache_key = entry['custom_id'].rsplit(':', 1)[0]
+            question_type = topics[cache_key]['topic']['questionType']
+            results[entry['custom_id']] = parse_completion_questions(content, question_type)
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            print(f"Unusable completion for batch request {entry['custom_id']}: {e}")
+    return results
+
+def prefill_cache_with_batch(specs, state_path, poll_seconds):
+    """Generate the uncached topics of ``specs`` through the Batch API into the question cache"""
+    state = None
+    if os.path.exists(state_path):
+        with open(state_path, encoding='utf-8') as f:
+            state = json.load(f)
+        if state.get('collected'):
+            print(f"Batch results from {state_path} were already collected")
+            return
+
+    # State files without 'submitted' were only written once submission had finished
+    if state is None or not state.get('submission_complete', 'submitted' not in state):
+        requests, topics = plan_batch_requests(specs)
+        if state is None:
+            if not requests:
+                print("Every topic is already cached; nothing to submit")
+                return
+            state = {'batch_ids': [], 'submitted': [], 'topics': topics}
+        else:
+            # An earlier run stopped part way through submitting; send only the rest
+            submitted = set(state['submitted'])
+            requests = [request for request in requests if request['custom_id'] not in submitted]
+            state['topics'] = {**topics, **state['topics']}
+            print(f"Resuming submission after batches {', '.join(state['batch_ids'])} from {state_path}")
+        print(f"Planned {len(requests)} batch requests for {len(topics)} topics")
+        submit_batches(requests, state, state_path)
+        state['submission_complete'] = True
+        save_batch_state(state_path, state)
+    else:
+        print(f"Resuming batches {', '.join(state['batch_ids'])} from {state_path}")
+
+    results = {}
+    for batch_id in state['batch_ids']:
+        batch = wait_for_batch(batch_id, poll_seconds)
+        if batch.status != 'completed':
+            print(f"Batch {batch_id} ended as {batch.status}; its topics will be generated live")
+        results.update(read_batch_output(batch, state['topics']))
+
+    cached = 0
+    for cache_key, entry in state['topics'].items():
+        parts = [results.get(f"{cache_key}:{part}") for part in range(1, entry['parts'] + 1)]
+        if not all(parts):
+            continue  # left to live generation rather than caching a partial topic
+        deduper = QuestionDeduper()
+        questions = [q for part in parts for q in part if deduper.add(q)]
+        if cache_topic_questions(entry['topic'], cache_key, questions):
+            cached += 1
+    print(f"Cached {cached} of {len(state['topics'])} topics from the Batch API")
+
+    state['collected'] = True
+    save_batch_state(state_path, state)
+
+def write_jsonl(path, results):
+    with open(path, 'w', encoding='utf-8') as f:
+        for result in results:
+            f.write(json.dumps(result, default=str) + '\n')
+
+def write_xlsx(path, results):
+    try:
+        import openpyxl
+    except ImportError:
+        sys.exit("Writing .xlsx files needs openpyxl (pip install openpyxl)")
+
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.title = 'Papers'
+    sheet.append(RESULT_COLUMNS)
+    for result in results:
+        sheet.append([
+            ', '.join(result[column]) if isinstance(result.get(column), list) else result.get(column)
+            for column in RESULT_COLUMNS
+        ])
+    workbook.save(path)
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate question papers in bulk")
+    parser.add_argument('input', help=".jsonl, .json or .xlsx file of paper specs")
+    parser.add_argument('output', help=".jsonl or .xlsx file for the results")
+    parser.add_argument('--workers', type=int, default=4, help="papers generated at once")
+    parser.add_argument('--topic-limit', type=int, default=TOPIC_CONCURRENCY,
+                        help="topics generated at once within a paper")
+    parser.add_argument('--checkpoint', help="progress file (default: <output>.checkpoint.jsonl)")
+    parser.add_argument('--offline', action='store_true',
+                        help="generate uncached topics through the OpenAI Batch API first")
+    parser.add_argument('--poll-seconds', type=float, default=60,
+                        help="how often to check on Batch API jobs")
+    args = parser.parse_args()
+    startup()
+
+    writers = {'.jsonl': write_jsonl, '.xlsx': write_xlsx}
+    write = writers.get(os.path.splitext(args.output)[1].lower())
+    if write is None:
+        sys.exit("Output must be a .jsonl or .xlsx file")
+
+    checkpoint_path = args.checkpoint or f"{args.output}.checkpoint.jsonl"
+    done = load_checkpoint(checkpoint_path)
+    results = {}
+    pending = set()
+    pending_keys = {}
+    skipped = failed = 0
+
+    specs = [
+        (index, spec, spec_key(spec))
+        for index, spec in enumerate(read_specs(args.input))
+    ]
+    if args.offline:
+        prefill_cache_with_batch(
+            [spec for index, spec, key in specs if (index, key) not in done],
+            f"{args.output}.batch.json",
+            args.poll_seconds
+        )
+
+    with open(checkpoint_path, 'a', encoding='utf-8') as checkpoint, \
+            ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix='paper') as executor:
+
+        def record(future):
+            nonlocal failed
+            index, key = pending_keys.pop(future)
+            result = future.result()
+            results[index] = result
+            if result['success']:
+                checkpoint.write(json.dumps({'spec': index, 'key': key, 'result': result}, default=str) + '\n')
+                checkpoint.flush()
+                os.fsync(checkpoint.fileno())
+            else:
+                failed += 1
+            print(f"[{len(results)}] spec {index}: "
+                  f"{'ok ' + str(result.get('paper_id')) if result['success'] else 'failed: ' + str(result.get('error'))}")
+
+        for index, spec, key in specs:
+            if (index, key) in done:
+                results[index] = done[(index, key)]
+                skipped += 1
+                continue
+            # Keep the queue short so thousands of specs are not all submitted up front
+            while len(pending) >= args.workers * 2:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    record(future)
+            future = executor.submit(run_spec, index, spec, args.topic_limit)
+            pending_keys[future] = (index, key)
+            pending.add(future)
+
+        for future in wait(pending).done:
+            record(future)
+
+    write(args.output, [results[index] for index in sorted(results)])
+    print(f"✅ {len(results)} specs: {len(results) - failed} succeeded "
+          f"({skipped} from checkpoint), {failed} failed; results in {args.output}")
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
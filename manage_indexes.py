@@ -0,0 +1,27 @@
+"""
+Create the MongoDB indexes used by app.py and audit the hot query plans.
+
+Usage:
+    python manage_indexes.py           # create indexes, then audit
+    python manage_indexes.py --audit   # audit only
+
+Exits with status 1 if an index cannot be created, or if any hot query
+falls back to a collection scan or sorts in memory (a blocking SORT stage).
+"""
+
+import sys
+
+from app import ensure_indexes, audit_query_plans
+
+if __name__ == '__main__':
+    if '--audit' not in sys.argv[1:]:
+        if ensure_indexes():
+            sys.exit(1)
+
+    failures = audit_query_plans()
+    if failures:
+        for name, stages in failures.items():
+            problem = 'COLLSCAN' if 'COLLSCAN' in stages else 'Blocking SORT'
+            print(f"❌ {problem} in {name}: {' <- '.join(stages)}")
+        sys.exit(1)
+    print("✅ All hot queries use an index, sorted by the index")
@@ -122,6 +122,21 @@ const App: React.FC = () => {
     }
   };
 
+  const waitForPdf = async (jobId: string): Promise<string> => {
+    for (let attempt = 0; attempt < 120; attempt++) {
+      const response = await fetch(`/api/pdf-jobs/${jobId}`);
+      const job = await response.json();
+      if (job.success && job.status === 'done' && job.pdf_url) {
+        return job.pdf_url;
+      }
+      if (!job.success || job.status === 'failed') {
+        throw new Error(job.error || 'Failed to generate PDF');
+      }
+      await new Promise(resolve => setTimeout(resolve, 1000));
+    }
+    throw new Error('Timed out waiting for PDF');
+  };
+
   const onSubmit = async (data: FormInputs) => {
     try {
       const response = await fetch('/api/generate-questions', {
@@ -136,14 +151,17 @@ const App: React.FC = () => {
 
       const result = await response.json();
 
-      if (result.success && result.pdf_url) {
-        // Open the PDF URL in a new tab
-        window.open(result.pdf_url, '_blank');
-        // Also redirect to thank you page
-        window.location.href = `/thankyou.html?pdf=${encodeURIComponent(result.pdf_url)}`;
-      } else {
+      if (!result.success) {
         throw new Error(result.error || 'Failed to generate questions');
       }
+
+      // The PDF is rendered in the background; wait for its job to finish
+      const pdfUrl = result.pdf_url || await waitForPdf(result.pdf_job_id);
+
+      // Open the PDF URL in a new tab
+      window.open(pdfUrl, '_blank');
+      // Also redirect to thank you page
+      window.location.href = `/thankyou.html?pdf=${encodeURIComponent(pdfUrl)}`;
     } catch (error) {
       console.error('Error:', error);
       alert('Failed to generate questions. Please try again.');
@@ -0,0 +1,17 @@
+"""
+app.py connects to MongoDB and builds its OpenAI and S3 clients at import, so
+the tests point it at an in-memory mongomock database and a dummy API key
+before anything imports it.
+"""
+
+import os
+import sys
+
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+import pymongo
+
+os.environ.setdefault('OPENAI_API_KEY', 'test-key')
+pymongo.MongoClient = mongomock.MongoClient
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
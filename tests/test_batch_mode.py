@@ -0,0 +1,211 @@
+import email.parser
+import itertools
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import openai
+import pytest
+
+import app
+import generate_papers
+
+ids = itertools.count()
+
+class FakeBatchAPI(BaseHTTPRequestHandler):
+    """Files and batches endpoints; every batch completes at once.
+
+    Each request line is answered with two MCQs, unless its custom_id ends
+    with one of ``server.failing_parts``. ``server.fail_batch_creates``
+    lists which batches.create calls (1-based) answer 500.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('content-type', 'application/json')
+        self.send_header('content-length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.path == '/v1/files':
+            message = email.parser.BytesParser().parsebytes(
+                b'Content-Type: ' + self.headers['Content-Type'].encode() + b'\r\n\r\n' + body
+            )
+            content = next(part.get_payload(decode=True) for part in message.get_payload()
+                           if part.get_param('name', header='content-disposition') == 'file')
+            file_id = f"file-{next(ids)}"
+            self.server.files[file_id] = content.decode()
+            self.send_json(200, {'id': file_id, 'object': 'file', 'bytes': len(content), 'created_at': 0,
+                                 'filename': 'questions.jsonl', 'purpose': 'batch', 'status': 'processed'})
+        elif self.path == '/v1/batches':
+            self.server.batch_creates += 1
+            if self.server.batch_creates in self.server.fail_batch_creates:
+                self.send_json(500, {'error': {'message': 'Server error', 'type': 'server_error'}})
+                return
+            request = json.loads(body)
+            batch_id = f"batch-{next(ids)}"
+            self.server.batches[batch_id] = request['input_file_id']
+            self.send_json(200, self.batch(batch_id, 'validating'))
+        else:
+            self.send_json(404, {'error': {'message': 'Not found'}})
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if parts[:2] == ['v1', 'batches'] and parts[2] in self.server.batches:
+            self.send_json(200, self.batch(parts[2], 'completed'))
+        elif parts[:2] == ['v1', 'files'] and parts[3:] == ['content'] and parts[2] in self.server.files:
+            payload = self.server.files[parts[2]].encode()
+            self.send_response(200)
+            self.send_header('content-type', 'application/octet-stream')
+            self.send_header('content-length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        else:
+            self.send_json(404, {'error': {'message': 'Not found'}})
+
+    def batch(self, batch_id, status):
+        input_file_id = self.server.batches[batch_id]
+        batch = {'id': batch_id, 'object': 'batch', 'endpoint': '/v1/chat/completions', 'input_file_id': input_file_id,
+                 'completion_window': '24h', 'status': status, 'created_at': 0}
+        if status == 'completed':
+            output_file_id = f"{input_file_id}-output"
+            if output_file_id not in self.server.files:
+                self.server.files[output_file_id] = self.output(self.server.files[input_file_id])
+            lines = self.server.files[input_file_id].splitlines()
+            batch.update(output_file_id=output_file_id, request_counts={'total': len(lines), 'completed': len(lines), 'failed': 0})
+        return batch
+
+    def output(self, input_file):
+        lines = []
+        for line in input_file.splitlines():
+            custom_id = json.loads(line)['custom_id']
+            if custom_id.endswith(tuple(self.server.failing_parts)):
+                response = {'status_code': 500, 'body': {'error': {'message': 'Server error'}}}
+            else:
+                questions = [
+                    {'question': f"Question {i} for {custom_id}?", 'options': ['w', 'x', 'y', 'z'],
+                     'answer': 'w', 'explanation': 'Because.'}
+                    for i in range(2)
+                ]
+                content = json.dumps({'questions': questions})
+                response = {'status_code': 200, 'body': {'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}}]}}
+            lines.append(json.dumps({'id': f"response-{custom_id}", 'custom_id': custom_id, 'response': response}))
+        return '\n'.join(lines) + '\n'
+
+@pytest.fixture(scope='module')
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeBatchAPI)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+
+@pytest.fixture
+def batch_api(server, monkeypatch):
+    server.files, server.batches = {}, {}
+    server.batch_creates = 0
+    server.fail_batch_creates = ()
+    server.failing_parts = ()
+    client = openai.OpenAI(api_key='test-key', base_url=f"http://127.0.0.1:{server.server_port}/v1", max_retries=0)
+    monkeypatch.setattr(generate_papers, 'openai_client', client)
+    return server
+
+def topic(name, num_questions=2):
+    return {
+        'sectionName': f"{name} {next(ids)}",
+        'questionType': 'MCQ',
+        'difficulty': 'Medium',
+        'bloomLevel': 'Apply',
+        'intelligenceType': 'Logical',
+        'numQuestions': str(num_questions)
+    }
+
+def spec(*topics):
+    return {'subjectName': 'Science', 'classGrade': '8', 'topics': list(topics)}
+
+def cache_key(spec, topic):
+    return app.generate_cache_key({**topic, 'subjectName': spec['subjectName'], 'classGrade': spec['classGrade']})
+
+def test_plan_skips_duplicate_cached_and_invalid_topics():
+    shared, cached, big = topic('Cells'), topic('Atoms'), topic('Plants', 25)
+    first, second = spec(shared, cached), spec(shared, big)
+    app.cache_topic_questions({**cached, 'subjectName': 'Science', 'classGrade': '8'}, cache_key(first, cached),
+                              [{'question': 'Q?', 'answer': 'a', 'explanation': 'e'}])
+
+    requests, topics = generate_papers.plan_batch_requests([first, second, spec(), {'_invalid': 'bad row'}])
+
+    parts = len(app.split_topic_batches({**big, 'subjectName': 'Science', 'classGrade': '8'}))
+    assert parts > 1
+    assert set(topics) == {cache_key(first, shared), cache_key(second, big)}
+    assert topics[cache_key(second, big)]['parts'] == parts
+    assert sorted(request['custom_id'] for request in requests) == sorted(
+        [f"{cache_key(first, shared)}:1"] + [f"{cache_key(second, big)}:{part}" for part in range(1, parts + 1)]
+    )
+
+def test_batch_results_fill_the_cache(batch_api, tmp_path):
+    cells, plants = topic('Cells'), topic('Plants', 25)
+    paper = spec(cells, plants)
+    state_path = tmp_path / 'results.jsonl.batch.json'
+
+    generate_papers.prefill_cache_with_batch([paper], str(state_path), 0)
+
+    assert len(app.find_cached_questions(cache_key(paper, cells))) == 2
+    parts = len(app.split_topic_batches({**plants, 'subjectName': 'Science', 'classGrade': '8'}))
+    assert len(app.find_cached_questions(cache_key(paper, plants))) == 2 * parts
+    state = json.loads(state_path.read_text())
+    assert state['collected'] and state['submission_complete']
+    assert batch_api.batch_creates == 1
+
+def test_topics_with_missing_parts_are_left_to_live_generation(batch_api, tmp_path):
+    cells, plants = topic('Cells'), topic('Plants', 25)
+    paper = spec(cells, plants)
+    batch_api.failing_parts = (f"{cache_key(paper, plants)}:2",)
+
+    generate_papers.prefill_cache_with_batch([paper], str(tmp_path / 'state.json'), 0)
+
+    assert app.find_cached_questions(cache_key(paper, cells)) is not None
+    assert app.find_cached_questions(cache_key(paper, plants)) is None
+
+def test_rerun_resumes_submitted_batches(batch_api, tmp_path, monkeypatch):
+    paper = spec(topic('Cells'))
+    state_path = str(tmp_path / 'state.json')
+    wait_for_batch = generate_papers.wait_for_batch
+
+    def interrupted(batch_id, poll_seconds):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(generate_papers, 'wait_for_batch', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        generate_papers.prefill_cache_with_batch([paper], state_path, 0)
+    monkeypatch.setattr(generate_papers, 'wait_for_batch', wait_for_batch)
+
+    generate_papers.prefill_cache_with_batch([paper], state_path, 0)
+
+    assert batch_api.batch_creates == 1
+    assert app.find_cached_questions(cache_key(paper, paper['topics'][0])) is not None
+
+def test_interrupted_submission_is_recorded_and_finished_on_rerun(batch_api, tmp_path, monkeypatch):
+    monkeypatch.setattr(generate_papers, 'BATCH_MAX_REQUESTS', 1)
+    first, second = topic('Cells'), topic('Atoms')
+    paper = spec(first, second)
+    state_path = tmp_path / 'state.json'
+    batch_api.fail_batch_creates = (2,)
+
+    with pytest.raises(openai.InternalServerError):
+        generate_papers.prefill_cache_with_batch([paper], str(state_path), 0)
+    state = json.loads(state_path.read_text())
+    assert len(state['batch_ids']) == 1
+    assert not state.get('submission_complete')
+
+    generate_papers.prefill_cache_with_batch([paper], str(state_path), 0)
+
+    # Only the request that had not gone out is submitted again
+    assert batch_api.batch_creates == 3
+    assert len(json.loads(state_path.read_text())['batch_ids']) == 2
+    assert app.find_cached_questions(cache_key(paper, first)) is not None
+    assert app.find_cached_questions(cache_key(paper, second)) is not None
@@ -0,0 +1,51 @@
+import pytest
+
+import app
+
+TOPIC = {
+    'sectionName': 'Cells',
+    'questionType': 'MCQ',
+    'difficulty': 'Medium',
+    'bloomLevel': 'Apply',
+    'intelligenceType': 'Logical',
+    'numQuestions': '5'
+}
+
+def request_with(topics):
+    return {'subjectName': 'Science', 'classGrade': '8', 'topics': topics}
+
+@pytest.mark.parametrize('topics', [[], {}, 'Cells', None, {'0': TOPIC}])
+def test_topics_must_be_a_non_empty_list(topics):
+    assert app.validate_generation_request(request_with(topics)) == "topics must be a non-empty list"
+
+def test_topics_must_be_objects():
+    assert app.validate_generation_request(request_with([TOPIC, 'Cells'])) == "Topic 2 must be a JSON object"
+
+def test_valid_request():
+    assert app.validate_generation_request(request_with([TOPIC])) is None
+
+def test_empty_topics_is_a_bad_request():
+    response = app.app.test_client().post('/api/generate-questions', json=request_with([]))
+    assert response.status_code == 400
+    assert response.json['success'] is False
+
+def test_pdf_is_only_waited_for_on_request(monkeypatch):
+    async def generate_paper(data, limit=None):
+        return {'success': True, 'pdf_job_id': 'job', 'pdf_status': 'queued'}, 200
+    waits = []
+    def wait(job_id, timeout):
+        waits.append(timeout)
+        return {'status': 'done', 'pdf_key': 'papers/x.pdf'}
+    monkeypatch.setattr(app, 'generate_paper', generate_paper)
+    monkeypatch.setattr(app.pdf_jobs, 'wait', wait)
+    monkeypatch.setattr(app, 'paper_pdf_url', lambda key: f'https://s3/{key}')
+    client = app.app.test_client()
+
+    response = client.post('/api/generate-questions', json=request_with([TOPIC]))
+    assert waits == []
+    assert response.json['pdf_status'] == 'queued'
+    assert 'pdf_url' not in response.json
+
+    response = client.post('/api/generate-questions?wait_for_pdf=true', json=request_with([TOPIC]))
+    assert waits == [app.PDF_JOB_WAIT_SECONDS]
+    assert response.json['pdf_url'] == 'https://s3/papers/x.pdf'
@@ -0,0 +1,53 @@
+from pymongo.errors import OperationFailure
+
+import app
+
+class FakeDatabase:
+    def __init__(self):
+        self.commands = []
+
+    def command(self, *args, **kwargs):
+        self.commands.append((args, kwargs))
+
+class FakeCollection:
+    def __init__(self, name, error=None):
+        self.name = name
+        self.error = error
+        self.database = FakeDatabase()
+        self.created = []
+
+    def create_index(self, keys, **options):
+        if self.error:
+            raise self.error
+        self.created.append(keys)
+        return '_'.join(f'{field}_{direction}' for field, direction in keys)
+
+def test_one_failing_index_does_not_stop_the_rest(monkeypatch):
+    broken = FakeCollection('broken', OperationFailure('boom', code=2))
+    fine = FakeCollection('fine')
+    monkeypatch.setattr(app, 'required_indexes', lambda: [
+        (broken, [('a', 1)], {}),
+        (fine, [('b', 1)], {}),
+        (fine, [('c', -1)], {}),
+    ])
+    assert list(app.ensure_indexes()) == ['broken.a_1']
+    assert fine.created == [[('b', 1)], [('c', -1)]]
+
+def test_changed_ttl_is_updated_with_coll_mod(monkeypatch):
+    cache = FakeCollection('question_cache', OperationFailure('conflict', code=app.INDEX_OPTIONS_CONFLICT))
+    monkeypatch.setattr(app, 'required_indexes', lambda: [
+        (cache, [('created_at', 1)], {'expireAfterSeconds': 3600}),
+    ])
+    assert app.ensure_indexes() == {}
+    assert cache.database.commands == [
+        (('collMod', 'question_cache'), {'index': {'keyPattern': {'created_at': 1}, 'expireAfterSeconds': 3600}})
+    ]
+
+def test_other_option_conflicts_are_reported(monkeypatch):
+    cache = FakeCollection('question_cache', OperationFailure('conflict', code=app.INDEX_OPTIONS_CONFLICT))
+    monkeypatch.setattr(app, 'required_indexes', lambda: [(cache, [('cache_key', 1)], {'unique': True})])
+    assert list(app.ensure_indexes()) == ['question_cache.cache_key_1']
+    assert cache.database.commands == []
+
+def test_required_indexes_are_created():
+    assert app.ensure_indexes() == {}
@@ -0,0 +1,99 @@
+from datetime import datetime, timedelta
+
+import mongomock
+
+import app
+
+def make_queue(handler=lambda job: {'result': 'ok'}, max_attempts=2, retry_seconds=0):
+    # No worker threads: the tests claim and run jobs themselves
+    return app.JobQueue(mongomock.MongoClient().db.jobs, handler, name='test', workers=0,
+                        max_attempts=max_attempts, retry_seconds=retry_seconds)
+
+def expire_lease(queue, job_id):
+    queue.collection.update_one({'_id': job_id}, {'$set': {'lease_expires_at': datetime.utcnow() - timedelta(seconds=1)}})
+
+def test_job_runs_to_done():
+    queue = make_queue()
+    job_id = queue.enqueue(paper_id='p')
+    queue.run_job(queue.claim('w1'))
+    job = queue.get(job_id)
+    assert job['status'] == 'done'
+    assert job['result'] == 'ok'
+
+def test_expired_lease_with_no_attempts_left_fails():
+    queue = make_queue()
+    job_id = queue.enqueue(paper_id='p')
+    for attempt in range(2):
+        assert queue.claim(f'w{attempt}')['_id'] == job_id
+        expire_lease(queue, job_id)
+    assert queue.claim('w2') is None
+    job = queue.get(job_id)
+    assert job['status'] == 'failed'
+    assert 'Lease expired' in job['error']
+    assert queue.wait(job_id, 0)['status'] == 'failed'
+
+def test_worker_that_lost_its_lease_does_not_overwrite_result():
+    queue = make_queue(handler=lambda job: {'result': job['worker']})
+    job_id = queue.enqueue(paper_id='p')
+    stale = queue.claim('slow')
+    expire_lease(queue, job_id)
+    current = queue.claim('fast')
+    assert current['_id'] == job_id
+
+    queue.run_job(current)
+    queue.run_job(stale)
+    job = queue.get(job_id)
+    assert job['status'] == 'done'
+    assert job['result'] == 'fast'
+
+def test_failed_attempt_is_requeued_until_max_attempts():
+    def handler(job):
+        raise RuntimeError('boom')
+    queue = make_queue(handler=handler)
+    job_id = queue.enqueue(paper_id='p')
+    queue.run_job(queue.claim('w1'))
+    assert queue.get(job_id)['status'] == 'queued'
+    queue.run_job(queue.claim('w1'))
+    job = queue.get(job_id)
+    assert job['status'] == 'failed'
+    assert job['error'] == 'boom'
+
+def test_on_failure_runs_once_when_attempts_run_out():
+    failures = []
+    def handler(job):
+        raise RuntimeError('boom')
+    queue = make_queue(handler=handler)
+    queue.on_failure = lambda job, error: failures.append((job['_id'], error))
+    job_id = queue.enqueue(paper_id='p')
+    queue.run_job(queue.claim('w1'))
+    assert failures == []
+    queue.run_job(queue.claim('w1'))
+    assert failures == [(job_id, 'boom')]
+
+def test_on_failure_runs_when_last_lease_expires():
+    failures = []
+    queue = make_queue()
+    queue.on_failure = lambda job, error: failures.append(job['_id'])
+    job_id = queue.enqueue(paper_id='p')
+    for attempt in range(2):
+        queue.claim(f'w{attempt}')
+        expire_lease(queue, job_id)
+    queue.claim('w2')
+    queue.claim('w3')
+    assert failures == [job_id]
+
+def test_failed_attempt_waits_before_it_is_retried():
+    def handler(job):
+        raise RuntimeError('S3 unavailable')
+    queue = make_queue(handler=handler, max_attempts=3, retry_seconds=60)
+    job_id = queue.enqueue(paper_id='p')
+    queue.run_job(queue.claim('w1'))
+    job = queue.get(job_id)
+    assert job['status'] == 'queued'
+    assert job['not_before'] > datetime.utcnow() + timedelta(seconds=50)
+    assert queue.claim('w1') is None
+
+    queue.collection.update_one({'_id': job_id}, {'$set': {'not_before': datetime.utcnow() - timedelta(seconds=1)}})
+    queue.run_job(queue.claim('w1'))
+    # The second retry backs off twice as long
+    assert queue.get(job_id)['not_before'] > datetime.utcnow() + timedelta(seconds=110)
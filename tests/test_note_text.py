@@ -0,0 +1,40 @@
+import app
+
+TOPIC = {
+    'subjectName': 'Science',
+    'classGrade': '8',
+    'sectionName': 'Cells',
+    'questionType': 'MCQ',
+    'difficulty': 'Medium',
+    'bloomLevel': 'Apply',
+    'intelligenceType': 'Logical',
+    'numQuestions': '1'
+}
+QUESTIONS = [{'question': 'Q?', 'options': ['a', 'b', 'c', 'd'], 'answer': 'a', 'explanation': 'e'}]
+
+def add_note(**fields):
+    return str(app.db['notes'].insert_one({'filename': 'notes/x.pdf', 'text_status': 'pending', **fields}).inserted_id)
+
+def test_note_is_marked_failed_when_extraction_fails_for_good():
+    def handler(job):
+        raise ValueError('EOF marker not found')
+    note_id = add_note()
+    queue = app.JobQueue(app.db['test_note_jobs'], handler, workers=0, max_attempts=2, retry_seconds=0,
+                         on_failure=app.mark_note_text_failed)
+    queue.enqueue(note_id=note_id)
+    queue.run_job(queue.claim('w'))
+    assert app.note_text_status(note_id) == 'pending'
+    queue.run_job(queue.claim('w'))
+    assert app.note_text_status(note_id) == 'failed'
+    assert app.db['notes'].find_one({'_id': app.ObjectId(note_id)})['text_error'] == 'EOF marker not found'
+
+def test_note_text_jobs_mark_notes_failed():
+    assert app.note_text_jobs.on_failure is app.mark_note_text_failed
+
+def test_questions_for_a_failed_note_are_cached():
+    topic = {**TOPIC, 'noteId': add_note(text_status='failed')}
+    assert app.cache_topic_questions(topic, 'note-text-test-failed', QUESTIONS)
+
+def test_questions_for_a_pending_note_are_not_cached():
+    topic = {**TOPIC, 'noteId': add_note()}
+    assert not app.cache_topic_questions(topic, 'note-text-test-pending', QUESTIONS)
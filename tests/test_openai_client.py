@@ -0,0 +1,144 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import openai
+import pytest
+
+import app
+
+COMPLETION = {
+    'id': 'chatcmpl-test',
+    'object': 'chat.completion',
+    'created': 0,
+    'model': 'gpt-test',
+    'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': 'ok'}, 'finish_reason': 'stop'}]
+}
+
+class FakeOpenAI(BaseHTTPRequestHandler):
+    """Answers /v1/chat/completions with the next response in server.plan"""
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('content-type', 'application/json')
+        self.send_header('content-length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests += 1
+        kind = self.server.plan.pop(0) if self.server.plan else 'ok'
+        if kind == '429':
+            self.send_json(429, {'error': {'message': 'Rate limit', 'type': 'requests'}}, {'retry-after': '0.3'})
+        elif kind == '500':
+            self.send_json(500, {'error': {'message': 'Server error', 'type': 'server_error'}})
+        elif kind == '400':
+            self.send_json(400, {'error': {'message': 'Bad request', 'type': 'invalid_request_error'}})
+        else:
+            if kind == 'slow':
+                time.sleep(1)
+            try:
+                self.send_json(200, COMPLETION)
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # the client gave up waiting (cancelled call)
+
+@pytest.fixture(scope='module')
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeOpenAI)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+
+@pytest.fixture
+def make_client(server):
+    server.plan = []
+    server.requests = 0
+
+    def make_client(plan, failure_threshold=5, reset_seconds=30.0, max_attempts=4):
+        server.plan[:] = plan
+        client = openai.AsyncOpenAI(
+            api_key='test-key',
+            base_url=f"http://127.0.0.1:{server.server_port}/v1",
+            max_retries=0
+        )
+        return app.ResilientOpenAIClient(
+            client,
+            max_attempts=max_attempts,
+            base_delay=0.01,
+            breaker=app.CircuitBreaker(failure_threshold=failure_threshold, reset_seconds=reset_seconds)
+        )
+    return make_client
+
+def complete(client):
+    return asyncio.run(client.create_chat_completion(model='gpt-test', messages=[{'role': 'user', 'content': 'hi'}]))
+
+def test_rate_limit_waits_for_retry_after(server, make_client):
+    client = make_client(['429'])
+    started = time.monotonic()
+    response = complete(client)
+    assert response.choices[0].message.content == 'ok'
+    assert time.monotonic() - started >= 0.3
+    assert server.requests == 2
+    assert client.stats()['rate_limited'] == 1
+    assert client.stats()['retries'] == 1
+
+def test_server_errors_are_retried(server, make_client):
+    client = make_client(['500', '500'])
+    assert complete(client).choices[0].message.content == 'ok'
+    assert server.requests == 3
+    assert client.stats()['server_errors'] == 2
+    assert client.stats()['circuit'] == 'closed'
+
+def test_bad_request_is_not_retried(server, make_client):
+    client = make_client(['400'])
+    with pytest.raises(openai.BadRequestError):
+        complete(client)
+    assert server.requests == 1
+    assert client.stats()['circuit'] == 'closed'
+
+def test_circuit_opens_and_fails_fast(server, make_client):
+    client = make_client(['500'] * 3, failure_threshold=3, max_attempts=3)
+    with pytest.raises(openai.InternalServerError):
+        complete(client)
+    assert client.stats()['circuit'] == 'open'
+    with pytest.raises(app.CircuitOpenError):
+        complete(client)
+    assert server.requests == 3
+    assert client.stats()['circuit_opens'] == 1
+    assert client.stats()['circuit_rejections'] == 1
+
+def test_trial_call_closes_circuit(server, make_client):
+    client = make_client(['500', 'ok'], failure_threshold=1, reset_seconds=0.1, max_attempts=1)
+    with pytest.raises(openai.InternalServerError):
+        complete(client)
+    time.sleep(0.15)
+    assert client.stats()['circuit'] == 'half-open'
+    complete(client)
+    assert client.stats()['circuit'] == 'closed'
+
+def test_cancelled_trial_does_not_keep_circuit_open(server, make_client):
+    client = make_client(['500', 'slow', 'ok'], failure_threshold=1, reset_seconds=0.1, max_attempts=1)
+    with pytest.raises(openai.InternalServerError):
+        complete(client)
+    time.sleep(0.15)
+
+    async def cancelled_trial():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(
+                client.create_chat_completion(model='gpt-test', messages=[{'role': 'user', 'content': 'hi'}]),
+                0.2
+            )
+    asyncio.run(cancelled_trial())
+    assert not client.breaker.trial_in_flight
+    assert complete(client).choices[0].message.content == 'ok'
+    assert client.stats()['circuit'] == 'closed'
@@ -0,0 +1,43 @@
+import json
+
+import app
+
+QUESTIONS = [
+    {'question': f'What is "{i}" {{in braces}}?', 'options': ['a', 'b]', '[c', 'd\\'], 'answer': 'a', 'explanation': 'e'}
+    for i in range(50)
+]
+COMPLETION = 'Here you go:\n```json\n' + json.dumps({'topic': {'name': 'x'}, 'questions': QUESTIONS}) + '\n```'
+
+def feed_in_pieces(parser, text, size):
+    questions = []
+    for start in range(0, len(text), size):
+        questions.extend(parser.feed(text[start:start + size]))
+    return questions
+
+def test_questions_are_parsed_whatever_the_delta_size():
+    for size in (1, 3, 64, len(COMPLETION)):
+        parser = app.QuestionStreamParser()
+        assert feed_in_pieces(parser, COMPLETION, size) == QUESTIONS
+        assert parser.count == len(QUESTIONS)
+
+def test_each_question_is_returned_once_its_brace_closes():
+    parser = app.QuestionStreamParser()
+    first = json.dumps(QUESTIONS[0])
+    assert parser.feed('{"questions": [' + first[:-1]) == []
+    assert parser.feed('}, ') == [QUESTIONS[0]]
+
+def test_only_the_question_being_read_is_kept():
+    parser = app.QuestionStreamParser()
+    text = json.dumps({'questions': QUESTIONS * 20})
+    largest = 0
+    for start in range(0, len(text), 7):
+        parser.feed(text[start:start + 7])
+        largest = max(largest, sum(len(part) for part in parser.parts))
+    assert parser.count == len(QUESTIONS) * 20
+    assert largest < 2 * len(json.dumps(QUESTIONS[0]))
+
+def test_content_is_kept_for_the_fallback_when_no_question_is_found():
+    parser = app.QuestionStreamParser()
+    text = json.dumps({'items': QUESTIONS[:2]})
+    assert feed_in_pieces(parser, text, 5) == []
+    assert parser.content == text
@@ -0,0 +1,78 @@
+import pytest
+
+import app
+
+def mcq(options, answer, **fields):
+    return {'question': 'Which one?', 'options': options, 'answer': answer, 'explanation': 'Because.', **fields}
+
+def test_labels_running_a_to_d_are_stripped():
+    fixed, errors = app.repair_question(mcq(['A) Paris', 'B) Rome', 'C) Oslo', 'D) Bern'], 'B) Rome'), 'MCQ')
+    assert errors == []
+    assert fixed['options'] == ['Paris', 'Rome', 'Oslo', 'Bern']
+    assert fixed['answer'] == 'Rome'
+
+@pytest.mark.parametrize('labels', [['(a) ', '(b) ', '(c) ', '(d) '], ['Option A: ', 'Option B: ', 'Option C: ', 'Option D: ']])
+def test_other_label_styles_are_stripped(labels):
+    options = [label + text for label, text in zip(labels, ['Paris', 'Rome', 'Oslo', 'Bern'])]
+    fixed, errors = app.repair_question(mcq(options, 'Oslo'), 'MCQ')
+    assert errors == []
+    assert fixed['options'] == ['Paris', 'Rome', 'Oslo', 'Bern']
+
+def test_species_names_are_not_treated_as_labels():
+    options = ['C. elegans', 'D. melanogaster', 'E. coli', 'S. cerevisiae']
+    fixed, errors = app.repair_question(mcq(options, 'C. elegans'), 'MCQ')
+    assert errors == []
+    assert fixed['options'] == options
+    assert fixed['answer'] == 'C. elegans'
+
+def test_text_that_looks_like_a_label_is_kept():
+    options = ['a. m.', 'p. m.', 'noon', 'midnight']
+    fixed, errors = app.repair_question(mcq(options, 'a. m.'), 'MCQ')
+    assert errors == []
+    assert fixed['options'] == options
+    assert fixed['answer'] == 'a. m.'
+
+def test_labels_out_of_order_are_kept():
+    options = ['B) Paris', 'A) Rome', 'C) Oslo', 'D) Bern']
+    fixed, errors = app.repair_question(mcq(options, 'B) Paris'), 'MCQ')
+    assert errors == []
+    assert fixed['options'] == options
+
+@pytest.mark.parametrize('answer', ['c', 'C)', '(C)', 'Option C', 'oslo', '  Oslo. '])
+def test_answer_by_letter_or_text(answer):
+    fixed, errors = app.repair_question(mcq(['Paris', 'Rome', 'Oslo', 'Bern'], answer), 'MCQ')
+    assert errors == []
+    assert fixed['answer'] == 'Oslo'
+
+def test_labelled_answer_must_name_its_own_option():
+    fixed, errors = app.repair_question(mcq(['Paris', 'Rome', 'Oslo', 'Bern'], 'A) Oslo'), 'MCQ')
+    assert errors == ['answer is not one of the options']
+
+def test_aliased_fields_and_dict_options():
+    question = {
+        'Question': 'Which one?',
+        'choices': {'a': 'Paris', 'b': 'Rome', 'c': 'Oslo', 'd': 'Bern'},
+        'correct_answer': 'd',
+        'rationale': 'Because.'
+    }
+    fixed, errors = app.repair_question(question, 'MCQ')
+    assert errors == []
+    assert fixed['options'] == ['Paris', 'Rome', 'Oslo', 'Bern']
+    assert fixed['answer'] == 'Bern'
+    assert fixed['explanation'] == 'Because.'
+
+def test_options_from_a_text_block():
+    fixed, errors = app.repair_question(mcq('A. Paris\nB. Rome\nC. Oslo\nD. Bern', 'Rome'), 'MCQ')
+    assert errors == []
+    assert fixed['options'] == ['Paris', 'Rome', 'Oslo', 'Bern']
+
+def test_invalid_mcqs_are_reported():
+    fixed, errors = app.repair_question(mcq(['Paris', 'Rome', 'Rome'], 'Lima', explanation=''), 'MCQ')
+    assert 'missing explanation' in errors
+    assert 'expected 4 options, got 2' in errors
+    assert app.repair_question('not a question', 'MCQ')[1] == ['not a JSON object']
+
+def test_short_answer_needs_no_options():
+    fixed, errors = app.repair_question({'question': 'Why?', 'answer': 42, 'explanation': 'Because.'}, 'Short')
+    assert errors == []
+    assert fixed['answer'] == '42'
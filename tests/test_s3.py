@@ -0,0 +1,80 @@
+import hashlib
+import io
+
+import boto3
+import pytest
+from botocore.stub import Stubber
+from moto import mock_aws
+
+import app
+
+@pytest.fixture
+def stubbed_s3(monkeypatch):
+    client = boto3.client('s3', region_name='us-east-1', aws_access_key_id='test', aws_secret_access_key='test')
+    monkeypatch.setattr(app, 's3_client', client)
+    with Stubber(client) as stubber:
+        yield stubber
+
+@pytest.mark.parametrize('code, status', [('404', 404), ('403', 403), ('500', 500)])
+def test_head_errors_count_as_missing(stubbed_s3, code, status):
+    stubbed_s3.add_client_error('head_object', service_error_code=code, http_status_code=status)
+    assert app.s3_object_exists('bucket', 'papers/x.pdf') is False
+
+def test_existing_object(stubbed_s3):
+    stubbed_s3.add_response('head_object', {'ContentLength': 10})
+    assert app.s3_object_exists('bucket', 'papers/x.pdf') is True
+
+BUCKET = 'notes-test'
+MB = 1024 * 1024
+
+@pytest.fixture
+def s3(monkeypatch):
+    with mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=BUCKET)
+        monkeypatch.setattr(app, 's3_client', client)
+        yield client
+
+def pdf_bytes(size):
+    return (b'%PDF-1.4\n' + bytes(range(256)) * (size // 256 + 1))[:size]
+
+def keys(s3):
+    return [obj['Key'] for obj in s3.list_objects_v2(Bucket=BUCKET).get('Contents', [])]
+
+def test_large_note_is_uploaded_in_parts(s3):
+    body = pdf_bytes(12 * MB)
+    size, sha256 = app.stream_to_s3(io.BytesIO(body), BUCKET, 'notes/big.pdf',
+                                    expected_sha256=hashlib.sha256(body).hexdigest())
+    assert (size, sha256) == (len(body), hashlib.sha256(body).hexdigest())
+    stored = s3.get_object(Bucket=BUCKET, Key='notes/big.pdf')
+    assert stored['ContentType'] == 'application/pdf'
+    assert stored['Body'].read() == body
+    # 12 MB in NOTE_UPLOAD_PART_SIZE (8 MB) parts
+    assert stored['ETag'].strip('"').endswith('-2')
+
+def test_small_note_is_a_single_put(s3):
+    body = pdf_bytes(100 * 1024)
+    size, sha256 = app.stream_to_s3(io.BytesIO(body), BUCKET, 'notes/small.pdf')
+    assert size == len(body)
+    stored = s3.get_object(Bucket=BUCKET, Key='notes/small.pdf')
+    assert stored['Body'].read() == body
+    assert '-' not in stored['ETag']
+
+@pytest.mark.parametrize('size', [100 * 1024, 12 * MB])
+def test_checksum_mismatch_leaves_nothing_behind(s3, size):
+    with pytest.raises(app.NoteUploadError, match='Checksum mismatch'):
+        app.stream_to_s3(io.BytesIO(pdf_bytes(size)), BUCKET, 'notes/corrupt.pdf', expected_sha256='0' * 64)
+    assert keys(s3) == []
+    assert s3.list_multipart_uploads(Bucket=BUCKET).get('Uploads', []) == []
+
+def test_oversize_note_is_rejected_and_aborted(s3):
+    with pytest.raises(app.NoteUploadError) as error:
+        app.stream_to_s3(io.BytesIO(pdf_bytes(20 * MB)), BUCKET, 'notes/huge.pdf', max_bytes=10 * MB)
+    assert error.value.status == 413
+    assert keys(s3) == []
+    assert s3.list_multipart_uploads(Bucket=BUCKET).get('Uploads', []) == []
+
+def test_non_pdf_is_rejected(s3):
+    with pytest.raises(app.NoteUploadError, match='Only PDF'):
+        app.stream_to_s3(io.BytesIO(b'hello'), BUCKET, 'notes/x.pdf')
+    assert keys(s3) == []
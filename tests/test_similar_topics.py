@@ -0,0 +1,76 @@
+import itertools
+
+import pytest
+
+import app
+
+QUESTIONS = [
+    {'question': f'Question {i}', 'options': ['a', 'b', 'c', 'd'], 'answer': 'a', 'explanation': 'e'}
+    for i in range(5)
+]
+keys = (f'similar-topic-test-{i}' for i in itertools.count())
+
+def topic(section_name, **overrides):
+    return {
+        'subjectName': 'Science',
+        'classGrade': '8',
+        'sectionName': section_name,
+        'questionType': 'MCQ',
+        'difficulty': 'Medium',
+        'bloomLevel': 'Apply',
+        'intelligenceType': 'Logical',
+        'numQuestions': '5',
+        **overrides
+    }
+
+def index_with(cached_topic):
+    index = app.SimilarTopicIndex()
+    index.loaded = True
+    key = next(keys)
+    app.topic_cache.set(key, QUESTIONS)
+    index.add(key, cached_topic)
+    return index
+
+@pytest.mark.parametrize('cached, requested', [
+    ('Chapter 1', 'Chapter 2'),
+    ('Unit 3', 'Unit 7'),
+    ('World War 1', 'World War 2'),
+    ('Part A', 'Part B'),
+    ('Reflection of light', 'Refraction of light'),
+    ('Linear equations in one variable', 'Linear equations in two variables'),
+])
+def test_different_topics_are_not_served(cached, requested):
+    index = index_with(topic(cached))
+    assert index.serve(topic(requested), next(keys)) is None
+
+@pytest.mark.parametrize('cached, requested', [
+    ('Chapter 1', 'Chapter 2'),
+    ('Unit 3', 'Unit 7'),
+    ('World War 1', 'World War 2'),
+    ('Part A', 'Part B'),
+])
+def test_numbers_and_letters_count_towards_similarity(cached, requested):
+    index = app.MinHashIndex()
+    index.add('cached', cached, None)
+    assert index.query(requested, 1.0) == []
+
+@pytest.mark.parametrize('cached, requested', [
+    ('Cells', 'cell'),
+    ('Basics of Algebra', 'Algebra basics'),
+    ('Photosynthesis', '  photosynthesis '),
+])
+def test_same_topic_in_other_words_is_served(cached, requested):
+    index = index_with(topic(cached))
+    questions, similar_topic = index.serve(topic(requested), next(keys))
+    assert questions == QUESTIONS
+    assert similar_topic == cached
+
+def test_other_question_settings_are_not_served():
+    index = index_with(topic('Cells'))
+    assert index.serve(topic('Cells', difficulty='Hard'), next(keys)) is None
+    assert index.serve(topic('Cells', subjectName='Biology'), next(keys)) is None
+
+def test_other_question_settings_are_seeded():
+    index = index_with(topic('Cells'))
+    seeds = index.seed_questions(topic('Cells', difficulty='Hard'), next(keys))
+    assert seeds == [q['question'] for q in QUESTIONS]